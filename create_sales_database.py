@@ -1,159 +1,351 @@
 import pandas as pd
+import numpy as np
 import sqlite3
 from datetime import datetime
+from time import perf_counter
+import argparse
+import hashlib
 import os
+import openpyxl
 
-def create_sqlite_database():
-    # File paths
-    excel_file = r'C:\Users\adina\OneDrive\DevSecOps\ArcadiaSales\files\Template.xlsx'
-    db_file = r'C:\Users\adina\OneDrive\DevSecOps\ArcadiaSales\files\arcadia_sales.db'
-    
-    # Read Excel file
+# Default locations; override with --excel / --db
+EXCEL_FILE = r'C:\Users\adina\OneDrive\DevSecOps\ArcadiaSales\files\Template.xlsx'
+DB_FILE = r'C:\Users\adina\OneDrive\DevSecOps\ArcadiaSales\files\arcadia_sales.db'
+
+# Rows per executemany() call; all chunks share one transaction
+INSERT_CHUNK_ROWS = 5000
+# Sheet rows per batch in --stream mode; each batch is committed before the next is read
+READ_BATCH_ROWS = 2000
+# s_no values per "IN (...)" lookup, below SQLite's bound-parameter limit
+LOOKUP_CHUNK = 900
+
+SALE_COLUMNS = [
+    's_no', 'booking_date', 'project', 'spg_praneeth', 'token', 'buyer_name', 'sol', 'type_of_sale',
+    'land_sqyards', 'sbua_sqft', 'facing', 'base_sqft_price', 'amenties_and_premiums',
+    'total_sale_price', 'amount_received', 'balance_amount',
+    'balance_tobe_received_by_plan_approval', 'notes', 'balance_tobe_received_during_exec',
+    'sale_person_name', 'crm_name'
+]
+INT_COLUMNS = ['s_no', 'token', 'land_sqyards']
+FLOAT_COLUMNS = ['sbua_sqft', 'base_sqft_price', 'amenties_and_premiums', 'total_sale_price',
+                 'amount_received', 'balance_amount', 'balance_tobe_received_by_plan_approval',
+                 'balance_tobe_received_during_exec']
+
+INSERT_SQL = f"""
+INSERT INTO sale_details (
+    {', '.join(SALE_COLUMNS)}
+) VALUES ({','.join('?' * len(SALE_COLUMNS))})
+"""
+
+# Incremental mode: rows are keyed on s_no and only written when their content hash
+# differs from the one stored at the previous import
+UPSERT_SQL = INSERT_SQL + f"""
+ON CONFLICT(s_no) WHERE s_no > 0 DO UPDATE SET
+    {', '.join(f'{c} = excluded.{c}' for c in SALE_COLUMNS if c not in ('s_no', 'sale_person_name', 'crm_name'))},
+    sale_person_name = COALESCE(excluded.sale_person_name, sale_person_name),
+    crm_name = COALESCE(excluded.crm_name, crm_name)
+"""
+
+CREATE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS sale_details (
+    s_no INTEGER,
+    booking_date DATE,
+    project TEXT,
+    spg_praneeth TEXT CHECK (spg_praneeth IN ('SPG','Praneeth')),
+    token INTEGER,
+    buyer_name TEXT,
+    sol TEXT,
+    type_of_sale TEXT CHECK (type_of_sale IN ('OTP','R')),
+    land_sqyards INTEGER,
+    sbua_sqft REAL,
+    facing TEXT,
+    base_sqft_price REAL,
+    amenties_and_premiums REAL,
+    total_sale_price REAL,
+    amount_received REAL,
+    balance_amount REAL,
+    balance_tobe_received_by_plan_approval REAL,
+    notes TEXT,
+    balance_tobe_received_during_exec REAL,
+    sale_person_name TEXT,
+    crm_name TEXT
+);
+"""
+
+def timed(label, started):
+    print(f"  {label}: {perf_counter() - started:.3f}s")
+    return perf_counter()
+
+def normalize_sales_frame(df):
+    # Cleans the sheet and computes the derived columns, column-at-a-time
+    # Convert date columns to proper format (ISO text, as stored by sqlite3's date adapter)
+    if 'booking_date' in df.columns:
+        df['booking_date'] = pd.to_datetime(df['booking_date'], errors='coerce').dt.strftime('%Y-%m-%d')
+
+    # Normalize allowed-list fields
+    if 'spg_praneeth' in df.columns:
+        df['spg_praneeth'] = df['spg_praneeth'].astype(str).str.strip().replace({
+            'spg': 'SPG', 'SPG': 'SPG', 'Spg': 'SPG',
+            'praneeth': 'Praneeth', 'Praneeth': 'Praneeth', 'PRANEETH': 'Praneeth'
+        })
+    if 'type_of_sale' in df.columns:
+        df['type_of_sale'] = df['type_of_sale'].astype(str).str.strip().str.upper()
+
+    # Ensure buyer_name column exists (map from legacy 'name' if needed)
+    if 'buyer_name' not in df.columns and 'name' in df.columns:
+        df['buyer_name'] = df['name']
+    if 'buyer_name' not in df.columns:
+        df['buyer_name'] = None
+
+    # Ensure optional new columns exist
+    for opt_col in ['sale_person_name', 'crm_name']:
+        if opt_col not in df.columns:
+            df[opt_col] = None
+
+    # Convert numeric columns to appropriate types
+    numeric_columns = ['s_no', 'token', 'land_sqyards', 'sbua_sqft', 'base_sqft_price',
+                      'amenties_and_premiums', 'amount_received',
+                      'balance_tobe_received_during_exec']
+    for col in numeric_columns:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+
+    # Calculate fields
+    base = df['base_sqft_price'] if 'base_sqft_price' in df.columns else 0
+    prem = df['amenties_and_premiums'] if 'amenties_and_premiums' in df.columns else 0
+    land = df['land_sqyards'] if 'land_sqyards' in df.columns else 0
+    amt_received = df['amount_received'] if 'amount_received' in df.columns else 0
+
+    df['total_sale_price'] = (base + prem) * land
+    df['balance_amount'] = df['total_sale_price'] - amt_received
+
+    # OTP: the whole balance; R: 20% of the sale price less the balance; otherwise unset
+    tos = df['type_of_sale'] if 'type_of_sale' in df.columns else pd.Series('', index=df.index)
+    df['balance_tobe_received_by_plan_approval'] = np.select(
+        [tos.eq('OTP').to_numpy(), tos.eq('R').to_numpy()],
+        [df['balance_amount'].to_numpy(dtype=float),
+         (df['total_sale_price'] * 0.20 - df['balance_amount']).to_numpy(dtype=float)],
+        default=np.nan,
+    )
+    return df
+
+def frame_to_rows(df):
+    # Insert tuples in SALE_COLUMNS order, with plain Python values and NaN/NaT -> None
+    out = pd.DataFrame(index=df.index)
+    for col in SALE_COLUMNS:
+        if col not in df.columns:
+            out[col] = None
+        elif col in INT_COLUMNS:
+            out[col] = np.trunc(pd.to_numeric(df[col], errors='coerce')).astype('Int64')
+        elif col in FLOAT_COLUMNS:
+            out[col] = pd.to_numeric(df[col], errors='coerce').astype(float)
+        else:
+            out[col] = df[col]
+    out = out.astype(object)
+    return list(out.where(out.notna(), None).itertuples(index=False, name=None))
+
+def insert_rows(cursor, rows, sql=INSERT_SQL, chunk_size=INSERT_CHUNK_ROWS):
+    for start in range(0, len(rows), chunk_size):
+        cursor.executemany(sql, rows[start:start + chunk_size])
+    return len(rows)
+
+def row_hash(row):
+    return hashlib.sha1(repr(row).encode('utf-8')).hexdigest()
+
+def keyed_rows(rows):
+    # s_no -> row; rows without a usable s_no can't be matched and are skipped, and a
+    # repeated s_no keeps its last row (as a sequential re-import would)
+    keyed, skipped, duplicates = {}, 0, 0
+    for row in rows:
+        s_no = row[0]
+        if not s_no:
+            skipped += 1
+            continue
+        if s_no in keyed:
+            duplicates += 1
+        keyed[s_no] = row
+    return keyed, skipped, duplicates
+
+def ensure_import_tables(cursor):
+    cursor.execute(CREATE_TABLE_SQL)
+    # ON CONFLICT(s_no) needs a unique index. The web app creates one over all of s_no;
+    # otherwise index the keyed rows only, since rows loaded without an s_no hold 0
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'ux_sale_details_s_no'")
+    if not cursor.fetchone():
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_sale_details_s_no_keyed ON sale_details(s_no) WHERE s_no > 0")
+    cursor.execute("CREATE TABLE IF NOT EXISTS sale_import_hashes (s_no INTEGER PRIMARY KEY, row_hash TEXT NOT NULL)")
+
+def forget_app_schema(cursor):
+    # Call when sale_details has been (or is about to be) dropped. The web app's
+    # reporting rollup, search index and typeahead terms describe the old rows, and its
+    # columns, indexes and triggers went with the table. Bumping cache_versions 'schema'
+    # makes a running app recreate all of them on its next request; 'data' is bumped
+    # because the data-version triggers were dropped too, and browsers would otherwise be
+    # told their cached pages are still current.
+    cursor.execute("DROP TABLE IF EXISTS sales_monthly_rollup")
+    cursor.execute("DROP TABLE IF EXISTS sale_details_fts")
+    cursor.execute("DROP TABLE IF EXISTS suggest_terms")
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'cache_versions'")
+    if cursor.fetchone():
+        cursor.executemany(
+            "INSERT INTO cache_versions(name, version) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET version = version + 1",
+            [('data',), ('schema',)]
+        )
+
+def recreate_sale_details(cursor):
+    # Full reload: drop and recreate the table with constraints, and forget import hashes
+    cursor.execute("DROP TABLE IF EXISTS sale_details")
+    forget_app_schema(cursor)
+    cursor.execute(CREATE_TABLE_SQL)
+    cursor.execute("CREATE TABLE IF NOT EXISTS sale_import_hashes (s_no INTEGER PRIMARY KEY, row_hash TEXT NOT NULL)")
+    cursor.execute("DELETE FROM sale_import_hashes")
+
+def save_row_hashes(cursor, hashes, chunk_size=INSERT_CHUNK_ROWS):
+    insert_rows(
+        cursor, hashes,
+        sql="INSERT INTO sale_import_hashes(s_no, row_hash) VALUES (?, ?) "
+            "ON CONFLICT(s_no) DO UPDATE SET row_hash = excluded.row_hash",
+        chunk_size=chunk_size,
+    )
+
+def lookup_by_sno(cursor, sql, s_nos):
+    # sql has one "{}" for the placeholder list; returns all rows for the given keys
+    s_nos = list(s_nos)
+    found = []
+    for start in range(0, len(s_nos), LOOKUP_CHUNK):
+        chunk = s_nos[start:start + LOOKUP_CHUNK]
+        cursor.execute(sql.format(','.join('?' * len(chunk))), chunk)
+        found.extend(cursor.fetchall())
+    return found
+
+def upsert_changed_rows(cursor, rows):
+    # Writes only new or modified rows; existing rows keep their rowid, so payments
+    # (keyed on sale_details.rowid) stay attached. Only this batch's keys are looked up,
+    # so memory doesn't grow with the table.
+    keyed, skipped, duplicates = keyed_rows(rows)
+    known = dict(lookup_by_sno(cursor, "SELECT s_no, row_hash FROM sale_import_hashes WHERE s_no IN ({})", keyed))
+    existing = {r[0] for r in lookup_by_sno(cursor, "SELECT s_no FROM sale_details WHERE s_no IN ({})", keyed)}
+    changed, hashes = [], []
+    summary = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'skipped': skipped, 'duplicates': duplicates}
+    for s_no, row in keyed.items():
+        h = row_hash(row)
+        if known.get(s_no) == h:
+            summary['unchanged'] += 1
+            continue
+        summary['updated' if s_no in existing else 'inserted'] += 1
+        changed.append(row)
+        hashes.append((s_no, h))
+    insert_rows(cursor, changed, sql=UPSERT_SQL)
+    save_row_hashes(cursor, hashes)
+    return summary
+
+def write_batch(cursor, rows, incremental):
+    # Returns counts in the print_summary() keys
+    if incremental:
+        return upsert_changed_rows(cursor, rows)
+    insert_rows(cursor, rows)
+    # Record hashes so the next incremental run can skip unchanged rows
+    keyed, _, _ = keyed_rows(rows)
+    save_row_hashes(cursor, [(s_no, row_hash(row)) for s_no, row in keyed.items()])
+    return {'inserted': len(rows)}
+
+def iter_sheet_batches(ws, batch_rows=READ_BATCH_ROWS):
+    # Yields DataFrames of at most batch_rows rows from a read-only worksheet, so only
+    # one batch of cells is held in memory at a time
+    rows = ws.iter_rows(values_only=True)
+    header = next(rows, None)
+    if header is None:
+        return
+    columns = [str(h).strip() if h is not None else f'unnamed_{i}' for i, h in enumerate(header)]
+    # Frames are indexed by sheet row number (the header is row 1)
+    batch, row_nos = [], []
+    for row_no, values in enumerate(rows, 2):
+        if all(v is None for v in values):
+            continue  # trailing blank rows
+        batch.append(values)
+        row_nos.append(row_no)
+        if len(batch) >= batch_rows:
+            yield pd.DataFrame(batch, columns=columns, index=row_nos)
+            batch, row_nos = [], []
+    if batch:
+        yield pd.DataFrame(batch, columns=columns, index=row_nos)
+
+def print_summary(summary):
+    print("Import summary: " + ", ".join(f"{k}={v}" for k, v in summary.items()))
+
+def create_sqlite_database(excel_file=EXCEL_FILE, db_file=DB_FILE, incremental=False,
+                           stream=False, batch_rows=READ_BATCH_ROWS):
+    started = perf_counter()
+
+    # Read Excel file: the whole sheet, or (stream) a read-only handle consumed in batches
+    wb = None
     try:
-        df = pd.read_excel(excel_file, sheet_name='sale_details')
-        print(f"Successfully read Excel file: {excel_file}")
+        if stream:
+            wb = openpyxl.load_workbook(excel_file, read_only=True, data_only=True)
+            batches = iter_sheet_batches(wb['sale_details'], batch_rows)
+        else:
+            batches = [pd.read_excel(excel_file, sheet_name='sale_details')]
+        print(f"Successfully {'opened' if stream else 'read'} Excel file: {excel_file}")
     except Exception as e:
+        if wb is not None:
+            wb.close()
         print(f"Error reading Excel file: {e}")
         return
+    timings = {'read excel': perf_counter() - started}
 
     # Create SQLite connection
     conn = sqlite3.connect(db_file)
     cursor = conn.cursor()
 
-    # Drop and recreate table with constraints to enforce validations
-    drop_table_sql = """
-    DROP TABLE IF EXISTS sale_details;
-    """
-    create_table_sql = """
-    CREATE TABLE IF NOT EXISTS sale_details (
-        s_no INTEGER,
-        booking_date DATE,
-        project TEXT,
-        spg_praneeth TEXT CHECK (spg_praneeth IN ('SPG','Praneeth')),
-        token INTEGER,
-        buyer_name TEXT,
-        sol TEXT,
-        type_of_sale TEXT CHECK (type_of_sale IN ('OTP','R')),
-        land_sqyards INTEGER,
-        sbua_sqft REAL,
-        facing TEXT,
-        base_sqft_price REAL,
-        amenties_and_premiums REAL,
-        total_sale_price REAL,
-        amount_received REAL,
-        balance_amount REAL,
-        balance_tobe_received_by_plan_approval REAL,
-        notes TEXT,
-        balance_tobe_received_during_exec REAL,
-        sale_person_name TEXT,
-        crm_name TEXT
-    );
-    """
-    
+    # Full mode drops and recreates the table with constraints to enforce validations;
+    # incremental mode keeps it. Without --stream the load runs as one transaction, so a
+    # failed load leaves the previous table in place; with --stream each batch is
+    # committed as it is written.
     try:
-        cursor.execute(drop_table_sql)
-        cursor.execute(create_table_sql)
-        print("Created table 'sale_details'")
+        cursor.execute("BEGIN")
+        if incremental:
+            ensure_import_tables(cursor)
+        else:
+            recreate_sale_details(cursor)
+            print("Created table 'sale_details'")
     except Exception as e:
         print(f"Error creating table: {e}")
+        conn.rollback()
         conn.close()
+        if wb is not None:
+            wb.close()
         return
 
+    def stage(label, t):
+        timings[label] = timings.get(label, 0.0) + perf_counter() - t
+        return perf_counter()
+
     # Insert data into SQLite table
+    summary = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'skipped': 0, 'duplicates': 0}
     try:
-        # Convert date columns to proper format
-        if 'booking_date' in df.columns:
-            df['booking_date'] = pd.to_datetime(df['booking_date'], errors='coerce').apply(
-                lambda d: d.date() if pd.notnull(d) else None
-            )
-        
-        # Normalize allowed-list fields
-        if 'spg_praneeth' in df.columns:
-            df['spg_praneeth'] = df['spg_praneeth'].astype(str).str.strip().replace({
-                'spg': 'SPG', 'SPG': 'SPG', 'Spg': 'SPG',
-                'praneeth': 'Praneeth', 'Praneeth': 'Praneeth', 'PRANEETH': 'Praneeth'
-            })
-        if 'type_of_sale' in df.columns:
-            df['type_of_sale'] = df['type_of_sale'].astype(str).str.strip().str.upper()
-
-        # Ensure buyer_name column exists (map from legacy 'name' if needed)
-        if 'buyer_name' not in df.columns and 'name' in df.columns:
-            df['buyer_name'] = df['name']
-        if 'buyer_name' not in df.columns:
-            df['buyer_name'] = None
-
-        # Ensure optional new columns exist
-        for opt_col in ['sale_person_name', 'crm_name']:
-            if opt_col not in df.columns:
-                df[opt_col] = None
-
-        # Convert numeric columns to appropriate types
-        numeric_columns = ['s_no', 'token', 'land_sqyards', 'sbua_sqft', 'base_sqft_price',
-                          'amenties_and_premiums', 'amount_received',
-                          'balance_tobe_received_during_exec']
-        for col in numeric_columns:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-
-        # Calculate fields
-        base = df['base_sqft_price'] if 'base_sqft_price' in df.columns else 0
-        prem = df['amenties_and_premiums'] if 'amenties_and_premiums' in df.columns else 0
-        sbua = df['sbua_sqft'] if 'sbua_sqft' in df.columns else 0
-        land = df['land_sqyards'] if 'land_sqyards' in df.columns else 0
-        amt_received = df['amount_received'] if 'amount_received' in df.columns else 0
-
-        df['total_sale_price'] = (base + prem) * land
-        df['balance_amount'] = df['total_sale_price'] - amt_received
-
-        def compute_plan_approval(row):
-            tos = row.get('type_of_sale', '')
-            if tos == 'OTP':
-                return row['balance_amount']
-            elif tos == 'R':
-                return (row['total_sale_price'] * 0.20) - row['balance_amount']
-            return None
-
-        df['balance_tobe_received_by_plan_approval'] = df.apply(compute_plan_approval, axis=1)
-
-        # Prepare insert
-        insert_sql = """
-        INSERT INTO sale_details (
-            s_no, booking_date, project, spg_praneeth, token, buyer_name, sol, type_of_sale,
-            land_sqyards, sbua_sqft, facing, base_sqft_price, amenties_and_premiums,
-            total_sale_price, amount_received, balance_amount,
-            balance_tobe_received_by_plan_approval, notes, balance_tobe_received_during_exec,
-            sale_person_name, crm_name
-        ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-        """
-
-        rows = []
-        for _, r in df.iterrows():
-            rows.append((
-                int(r['s_no']) if not pd.isna(r.get('s_no')) else None,
-                r.get('booking_date'),
-                r.get('project'),
-                r.get('spg_praneeth'),
-                int(r['token']) if not pd.isna(r.get('token')) else None,
-                r.get('buyer_name'),
-                r.get('sol'),
-                r.get('type_of_sale'),
-                int(r['land_sqyards']) if not pd.isna(r.get('land_sqyards')) else None,
-                float(r['sbua_sqft']) if not pd.isna(r.get('sbua_sqft')) else None,
-                r.get('facing'),
-                float(r['base_sqft_price']) if not pd.isna(r.get('base_sqft_price')) else None,
-                float(r['amenties_and_premiums']) if not pd.isna(r.get('amenties_and_premiums')) else None,
-                float(r['total_sale_price']) if not pd.isna(r.get('total_sale_price')) else None,
-                float(r['amount_received']) if not pd.isna(r.get('amount_received')) else None,
-                float(r['balance_amount']) if not pd.isna(r.get('balance_amount')) else None,
-                float(r['balance_tobe_received_by_plan_approval']) if not pd.isna(r.get('balance_tobe_received_by_plan_approval')) else None,
-                r.get('notes'),
-                float(r['balance_tobe_received_during_exec']) if not pd.isna(r.get('balance_tobe_received_during_exec')) else None,
-                r.get('sale_person_name'),
-                r.get('crm_name')
-            ))
-
-        cursor.executemany(insert_sql, rows)
-        print(f"Successfully loaded {len(rows)} rows into 'sale_details' table")
+        t = perf_counter()
+        for n, df in enumerate(batches, 1):
+            t = stage('read excel', t)
+            df = normalize_sales_frame(df)
+            t = stage('normalize', t)
+            rows = frame_to_rows(df)
+            t = stage('build rows', t)
+            for k, v in write_batch(cursor, rows, incremental).items():
+                summary[k] += v
+            t = stage('upsert' if incremental else 'insert', t)
+            if stream:
+                conn.commit()
+                t = stage('commit', t)
+                print(f"  batch {n}: {len(rows)} rows")
+        conn.commit()
+        stage('commit', t)
+        for label, secs in timings.items():
+            print(f"  {label}: {secs:.3f}s")
+        if incremental:
+            print_summary(summary)
+        else:
+            print(f"Successfully loaded {summary['inserted']} rows into 'sale_details' table")
         
         # Verify data was inserted
         cursor.execute("SELECT COUNT(*) FROM sale_details")
@@ -161,11 +353,24 @@ def create_sqlite_database():
         print(f"Verified {count} records in the database")
         
     except Exception as e:
+        conn.rollback()
         print(f"Error inserting data: {e}")
     finally:
-        conn.commit()
         conn.close()
-        print(f"Database created successfully at: {db_file}")
+        if wb is not None:
+            wb.close()
+        print(f"Database {'updated' if incremental else 'created'} successfully at: {db_file}")
+        timed('total', started)
 
 if __name__ == "__main__":
-    create_sqlite_database()
+    parser = argparse.ArgumentParser(description="Load the 'sale_details' sheet of an Excel workbook into SQLite")
+    parser.add_argument('--excel', default=EXCEL_FILE, help='source workbook')
+    parser.add_argument('--db', default=DB_FILE, help='SQLite database file')
+    parser.add_argument('--incremental', action='store_true',
+                        help='upsert new/changed rows keyed on s_no instead of dropping and reloading the table')
+    parser.add_argument('--stream', action='store_true',
+                        help='read the sheet in batches (openpyxl read-only) and commit each batch; bounded memory')
+    parser.add_argument('--batch-rows', type=int, default=READ_BATCH_ROWS, help='rows per batch with --stream')
+    args = parser.parse_args()
+    create_sqlite_database(args.excel, args.db, incremental=args.incremental,
+                           stream=args.stream, batch_rows=args.batch_rows)
@@ -1,8 +1,16 @@
 import sqlite3
+import argparse
 import pandas as pd
 from pathlib import Path
 
-def create_sqlite_database(excel_path, db_path):
+def create_sqlite_database(excel_path, db_path, incremental=False, stream=False):
+    if incremental or stream:
+        # to_sql(if_exists='replace') below wipes the table (and with it the rowids that
+        # payments point at), and read_excel holds the whole sheet in memory; these
+        # modes go through create_sales_database's upsert / batched reader instead
+        from create_sales_database import create_sqlite_database as load_workbook
+        return load_workbook(excel_path, db_path, incremental=incremental, stream=stream)
+
     # Read the Excel file
     try:
         df = pd.read_excel(excel_path, sheet_name='sale_details')
@@ -51,6 +59,9 @@ def create_sqlite_database(excel_path, db_path):
     # Write the data to SQLite
     try:
         df.to_sql('sale_details', conn, if_exists='replace', index=False)
+        from create_sales_database import forget_app_schema
+        forget_app_schema(cursor)
+        conn.commit()
         print(f"Successfully loaded {len(df)} rows into SQLite database")
     except Exception as e:
         print(f"Error writing to database: {e}")
@@ -60,9 +71,16 @@ def create_sqlite_database(excel_path, db_path):
 if __name__ == "__main__":
     # Define paths
     base_dir = Path(r"C:\Users\adina\OneDrive\DevSecOps\ArcadiaSales\files")
-    excel_file = base_dir / "Template.xlsx"
-    db_file = base_dir / "arcadia_sales.db"
+    parser = argparse.ArgumentParser(description="Convert the 'sale_details' sheet to SQLite")
+    parser.add_argument('--excel', type=Path, default=base_dir / "Template.xlsx")
+    parser.add_argument('--db', type=Path, default=base_dir / "arcadia_sales.db")
+    parser.add_argument('--incremental', action='store_true',
+                        help='upsert new/changed rows keyed on s_no instead of replacing the table')
+    parser.add_argument('--stream', action='store_true',
+                        help='read the sheet in batches with bounded memory (loads via create_sales_database)')
+    args = parser.parse_args()
+    excel_file, db_file = args.excel, args.db
     
     print(f"Starting conversion from {excel_file} to {db_file}")
-    create_sqlite_database(excel_file, db_file)
+    create_sqlite_database(excel_file, db_file, incremental=args.incremental, stream=args.stream)
     print("Conversion completed successfully!")
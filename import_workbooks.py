@@ -0,0 +1,249 @@
+import argparse
+import csv
+import glob
+import os
+import queue
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Manager
+from time import perf_counter
+
+import openpyxl
+
+from create_sales_database import (
+    INSERT_CHUNK_ROWS, READ_BATCH_ROWS, SALE_COLUMNS, ensure_import_tables, frame_to_rows,
+    iter_sheet_batches, normalize_sales_frame, print_summary, recreate_sale_details, write_batch,
+)
+
+# Imports every project office's copy of Template.xlsx into one database. Workbooks are
+# parsed and validated in a process pool; validated batches go through a queue to this
+# process, the only one that writes to SQLite.
+#
+#   python import_workbooks.py offices/ "incoming/*.xlsx" --db arcadia_sales.db --incremental
+
+VALID_SPG = ('SPG', 'Praneeth')
+VALID_TOS = ('OTP', 'R')
+S_NO, SPG, TOS = SALE_COLUMNS.index('s_no'), SALE_COLUMNS.index('spg_praneeth'), SALE_COLUMNS.index('type_of_sale')
+
+def expand_inputs(inputs):
+    # Directories contribute their *.xlsx files; anything else is treated as a glob
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            matches = glob.glob(os.path.join(item, '*.xlsx'))
+        else:
+            matches = glob.glob(item)
+        for path in sorted(matches):
+            # skip Excel's "~$Template.xlsx" lock files
+            if os.path.basename(path).startswith('~$'):
+                continue
+            path = os.path.abspath(path)
+            if path not in files:
+                files.append(path)
+    return files
+
+def reject_reason(row):
+    if not row[S_NO]:
+        return 'missing s_no'
+    if row[SPG] not in VALID_SPG:
+        return f'invalid spg_praneeth {row[SPG]!r}'
+    if row[TOS] not in VALID_TOS:
+        return f'invalid type_of_sale {row[TOS]!r}'
+    return None
+
+def parse_workbook(file_idx, path, sheets, batch_rows, out):
+    # Runs in a worker process. Puts ('rows', file_idx, sheet, [(row_no, row), ...]) per
+    # validated batch, then exactly one ('done', file_idx, report).
+    started = perf_counter()
+    report = {'file': path, 'sheets': [], 'rows': 0, 'rejects': [], 'error': None}
+    wb = None
+    try:
+        wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        names = wb.sheetnames if sheets == ['*'] else [s for s in sheets if s in wb.sheetnames]
+        if not names:
+            raise ValueError(f"no sheet named {', '.join(sheets)}")
+        for sheet in names:
+            report['sheets'].append(sheet)
+            for df in iter_sheet_batches(wb[sheet], batch_rows):
+                rows = frame_to_rows(normalize_sales_frame(df))
+                good = []
+                for row_no, row in zip(df.index.tolist(), rows):
+                    reason = reject_reason(row)
+                    if reason:
+                        report['rejects'].append((sheet, row_no, row[S_NO], reason))
+                    else:
+                        good.append((row_no, row))
+                report['rows'] += len(rows)
+                if good:
+                    out.put(('rows', file_idx, sheet, good))
+    except Exception as e:
+        report['error'] = str(e)
+    finally:
+        if wb is not None:
+            wb.close()
+        report['seconds'] = perf_counter() - started
+        out.put(('done', file_idx, None, report))
+
+def collect(cursor, files, sheets, workers, batch_rows):
+    # Stages every validated row in a temp table as batches arrive, in whatever order
+    # the workers finish; returns the per-file reports
+    cursor.execute(
+        f"CREATE TEMP TABLE import_staging (file_idx, sheet, row_no, {', '.join(SALE_COLUMNS)})"
+    )
+    insert_sql = f"INSERT INTO import_staging VALUES ({','.join('?' * (len(SALE_COLUMNS) + 3))})"
+    reports = {}
+    with Manager() as manager, ProcessPoolExecutor(max_workers=workers) as pool:
+        # bounded, so slow writes push back on the parsers instead of piling up in memory
+        out = manager.Queue(maxsize=workers * 4)
+        futures = {
+            pool.submit(parse_workbook, idx, path, sheets, batch_rows, out): idx
+            for idx, path in enumerate(files)
+        }
+        while len(reports) < len(files):
+            try:
+                kind, idx, sheet, payload = out.get(timeout=1)
+            except queue.Empty:
+                # a worker that died without reporting (e.g. killed) would otherwise hang us
+                for future, idx in futures.items():
+                    if future.done() and future.exception() and idx not in reports:
+                        reports[idx] = {'file': files[idx], 'sheets': [], 'rows': 0, 'rejects': [],
+                                        'error': str(future.exception()), 'seconds': 0.0}
+                continue
+            if kind == 'rows':
+                cursor.executemany(insert_sql, [(idx, sheet, row_no) + row for row_no, row in payload])
+            else:
+                reports[idx] = payload
+    return reports
+
+def reject_duplicates(cursor, reports):
+    # An s_no that occurs more than once (within or across files) is rejected everywhere:
+    # which copy is right isn't ours to guess, and the outcome must not depend on
+    # which worker finished first
+    cursor.execute(
+        "SELECT file_idx, sheet, row_no, s_no FROM import_staging WHERE s_no IN "
+        "(SELECT s_no FROM import_staging GROUP BY s_no HAVING COUNT(*) > 1) ORDER BY s_no, file_idx, row_no"
+    )
+    dups = cursor.fetchall()
+    files_by_sno = {}
+    for file_idx, _, _, s_no in dups:
+        files_by_sno.setdefault(s_no, set()).add(os.path.basename(reports[file_idx]['file']))
+    for file_idx, sheet, row_no, s_no in dups:
+        reports[file_idx]['rejects'].append(
+            (sheet, row_no, s_no, f"duplicate s_no (in {', '.join(sorted(files_by_sno[s_no]))})")
+        )
+    cursor.execute(
+        "DELETE FROM import_staging WHERE s_no IN "
+        "(SELECT s_no FROM import_staging GROUP BY s_no HAVING COUNT(*) > 1)"
+    )
+    return len(dups)
+
+def write_staged(conn, incremental):
+    # Moves the staged rows into sale_details in one transaction
+    cursor, reader = conn.cursor(), conn.cursor()
+    summary = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'skipped': 0, 'duplicates': 0}
+    cursor.execute("BEGIN")
+    try:
+        if incremental:
+            ensure_import_tables(cursor)
+        else:
+            recreate_sale_details(cursor)
+        reader.execute(f"SELECT {', '.join(SALE_COLUMNS)} FROM import_staging ORDER BY file_idx, sheet, row_no")
+        while True:
+            rows = reader.fetchmany(INSERT_CHUNK_ROWS)
+            if not rows:
+                break
+            for k, v in write_batch(cursor, rows, incremental).items():
+                summary[k] += v
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return summary
+
+def print_report(reports, files):
+    print(f"{'file':<40} {'rows':>7} {'loaded':>7} {'rejects':>7} {'secs':>7}")
+    for idx in range(len(files)):
+        r = reports[idx]
+        name = os.path.basename(r['file'])
+        if r['error']:
+            print(f"{name:<40} {'-':>7} {'-':>7} {'-':>7} {r['seconds']:>7.2f}  ERROR: {r['error']}")
+            continue
+        rejected = len(r['rejects'])
+        print(f"{name:<40} {r['rows']:>7} {r['rows'] - rejected:>7} {rejected:>7} {r['seconds']:>7.2f}")
+        for sheet, row_no, s_no, reason in r['rejects'][:5]:
+            print(f"    {sheet}!{row_no} s_no={s_no}: {reason}")
+        if rejected > 5:
+            print(f"    ... {rejected - 5} more")
+
+def write_rejects_csv(path, reports, files):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        w = csv.writer(f)
+        w.writerow(['file', 'sheet', 'row', 's_no', 'reason'])
+        for idx in range(len(files)):
+            for sheet, row_no, s_no, reason in reports[idx]['rejects']:
+                w.writerow([reports[idx]['file'], sheet, row_no, s_no, reason])
+
+def write_rejects(path, reports, files):
+    if path:
+        write_rejects_csv(path, reports, files)
+        print(f"Rejected rows written to {path}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Import many sale_details workbooks into one SQLite database")
+    parser.add_argument('inputs', nargs='+', help='workbook files, directories or glob patterns')
+    parser.add_argument('--db', required=True, help='SQLite database file')
+    parser.add_argument('--incremental', action='store_true',
+                        help='upsert by s_no instead of dropping and reloading sale_details')
+    parser.add_argument('--sheets', default='sale_details',
+                        help="comma-separated sheet names to read, or '*' for every sheet")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--batch-rows', type=int, default=READ_BATCH_ROWS)
+    parser.add_argument('--rejects-csv', help='write every rejected row to this CSV file')
+    args = parser.parse_args()
+
+    files = expand_inputs(args.inputs)
+    if not files:
+        parser.error('no workbooks matched')
+    sheets = [s.strip() for s in args.sheets.split(',') if s.strip()]
+    started = perf_counter()
+    print(f"Importing {len(files)} workbook(s) with {min(args.workers, len(files))} worker(s)")
+
+    conn = sqlite3.connect(args.db)
+    try:
+        reports = collect(conn.cursor(), files, sheets, min(args.workers, len(files)), args.batch_rows)
+        parsed = perf_counter()
+        if any(r['error'] for r in reports.values()):
+            # a partial import would silently drop an office's rows
+            print_report(reports, files)
+            print("Nothing written: fix the workbooks above and re-run")
+            raise SystemExit(1)
+        duplicates = reject_duplicates(conn.cursor(), reports)
+        conn.commit()  # ends the implicit transaction on the temp staging table
+        if not args.incremental:
+            # a full reload replaces sale_details, so rejected rows (e.g. an s_no two
+            # offices both used) would be deleted along with everything else
+            rejected = sum(len(r['rejects']) for r in reports.values())
+            cur = conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM import_staging")
+            staged = cur.fetchone()[0]
+            if rejected or not staged:
+                print_report(reports, files)
+                write_rejects(args.rejects_csv, reports, files)
+                if rejected:
+                    print(f"Nothing written: a full reload would delete the {rejected} rejected row(s); "
+                          "fix them or re-run with --incremental")
+                else:
+                    print("Nothing written: the workbooks hold no rows to load")
+                raise SystemExit(1)
+        summary = write_staged(conn, args.incremental)
+        summary['duplicates'] += duplicates
+    finally:
+        conn.close()
+
+    print_report(reports, files)
+    write_rejects(args.rejects_csv, reports, files)
+    print_summary(summary)
+    print(f"  parse: {parsed - started:.3f}s, write: {perf_counter() - parsed:.3f}s, total: {perf_counter() - started:.3f}s")
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,33 @@
 import os
+import sys
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file, Response, stream_with_context, g, has_app_context, make_response
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import create_engine, Column, Integer, String
+from sqlalchemy import create_engine, event, Column, Integer, String
 from sqlalchemy.orm import sessionmaker, declarative_base, scoped_session
-from io import StringIO, BytesIO
+from io import StringIO
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+import click
+import contextvars
+import bisect
+from collections import deque
 import re
 import csv
+import sqlite3
+import json
+import hashlib
+import hmac
+import base64
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.normpath(os.path.join(BASE_DIR, '..', 'arcadia_sales.db'))
@@ -25,7 +44,101 @@ except Exception:
 app = Flask(__name__)
 app.secret_key = os.environ.get('APP_SECRET', 'dev-secret-key')
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# Per-request SQL accounting. Every DBAPI connection the engine opens (raw_connection()
+# for the views, and the ORM's) hands out counting cursors; the counters live in a
+# ContextVar that only request threads set, so jobs and CLI commands are not counted.
+_sql_stats = contextvars.ContextVar('sql_stats', default=None)
+
+class SqlStats:
+    __slots__ = ('statements', 'rows', 'seconds')
+
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+        self.seconds = 0.0
+
+class CountingCursor(sqlite3.Cursor):
+    def _timed(self, method, *args):
+        stats = _sql_stats.get()
+        if stats is None:
+            return method(self, *args)
+        started = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            stats.statements += 1
+            stats.seconds += time.perf_counter() - started
+
+    def execute(self, *args):
+        return self._timed(sqlite3.Cursor.execute, *args)
+
+    def executemany(self, *args):
+        return self._timed(sqlite3.Cursor.executemany, *args)
+
+    def executescript(self, *args):
+        return self._timed(sqlite3.Cursor.executescript, *args)
+
+    def _fetched(self, rows):
+        stats = _sql_stats.get()
+        if stats is not None:
+            stats.rows += len(rows)
+        return rows
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self._fetched((row,))
+        return row
+
+    def fetchmany(self, *args):
+        return self._fetched(super().fetchmany(*args))
+
+    def fetchall(self):
+        return self._fetched(super().fetchall())
+
+    def __next__(self):
+        row = super().__next__()
+        self._fetched((row,))
+        return row
+
+class CountingConnection(sqlite3.Connection):
+    def cursor(self, factory=CountingCursor):
+        return super().cursor(factory)
+
+    # the built-in shortcuts would bypass cursor()
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def executescript(self, *args):
+        return self.cursor().executescript(*args)
+
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False, "factory": CountingConnection})
+
+# Connection tuning applied to every new SQLite connection; each value can be overridden
+# from the environment. WAL + busy_timeout let concurrent CRM writes wait instead of
+# failing with "database is locked".
+SQLITE_PRAGMAS = [
+    ('journal_mode', os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')),
+    ('busy_timeout', int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000'))),
+    ('synchronous', os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')),
+    # negative cache_size is in KiB
+    ('cache_size', -int(os.environ.get('SQLITE_CACHE_SIZE_KB', '16384'))),
+    ('mmap_size', int(os.environ.get('SQLITE_MMAP_SIZE', str(128 * 1024 * 1024)))),
+]
+
+@event.listens_for(engine, 'connect')
+def set_sqlite_pragmas(dbapi_conn, _record):
+    cur = dbapi_conn.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS:
+            if isinstance(value, str) and not value.isalpha():
+                continue  # ignore malformed overrides rather than build bad SQL
+            cur.execute(f"PRAGMA {name}={value}")
+    finally:
+        cur.close()
 SessionLocal = scoped_session(sessionmaker(bind=engine))
 Base = declarative_base()
 
@@ -38,6 +151,14 @@ class User(Base):
 
 Base.metadata.create_all(engine)
 
+SALE_FILTER_INDEXES = [
+    ('idx_sale_details_booking_date', 'booking_date'),
+    ('idx_sale_details_crm_date', 'crm_name, booking_date'),
+    ('idx_sale_details_sp_date', 'sale_person_name, booking_date'),
+    ('idx_sale_details_spg_date', 'spg_praneeth, booking_date'),
+    ('idx_sale_details_tos_date', 'type_of_sale, booking_date'),
+]
+
 def init_sqlite_schema():
     conn = engine.raw_connection()
     try:
@@ -79,6 +200,36 @@ def init_sqlite_schema():
             )
             """
         )
+        # Indexes backing the dashboard/export filters (booking_date ranges, optionally
+        # combined with one equality filter) and the per-CRM lists
+        for name, cols in SALE_FILTER_INDEXES:
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON sale_details({cols})")
+        # s_no must be unique; older databases may already hold duplicates, in which case
+        # keep a plain index so lookups stay fast and say so instead of failing to start
+        cur.execute("SELECT s_no FROM sale_details WHERE s_no IS NOT NULL GROUP BY s_no HAVING COUNT(*) > 1 LIMIT 5")
+        dup_snos = [r[0] for r in cur.fetchall()]
+        if dup_snos:
+            print(f"WARNING: duplicate s_no values in sale_details ({', '.join(map(str, dup_snos))}); s_no is not unique-indexed")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_sale_details_s_no ON sale_details(s_no)")
+        else:
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_sale_details_s_no ON sale_details(s_no)")
+            cur.execute("DROP INDEX IF EXISTS idx_sale_details_s_no")
+        # Serial number counter (see next_sale_sno); the trigger keeps it ahead of rows
+        # inserted with an explicit s_no, e.g. by the Excel import scripts
+        cur.execute("CREATE TABLE IF NOT EXISTS sequences (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        cur.execute(
+            "INSERT INTO sequences(name, value) SELECT 'sale_s_no', COALESCE(MAX(s_no), 0) FROM sale_details WHERE true "
+            "ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)"
+        )
+        cur.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_sale_details_s_no_seq AFTER INSERT ON sale_details
+            WHEN NEW.s_no > (SELECT value FROM sequences WHERE name = 'sale_s_no')
+            BEGIN
+                UPDATE sequences SET value = NEW.s_no WHERE name = 'sale_s_no';
+            END
+            """
+        )
         cur.execute("CREATE TABLE IF NOT EXISTS spg_options (value TEXT PRIMARY KEY)")
         cur.execute("CREATE TABLE IF NOT EXISTS sale_type_options (value TEXT PRIMARY KEY)")
         cur.execute("CREATE TABLE IF NOT EXISTS sales_people (full_name TEXT PRIMARY KEY)")
@@ -136,6 +287,8 @@ def ensure_option_tables():
             )
             """
         )
+        # Version counters for the in-process lookup cache (see cached_lookup)
+        cur.execute("CREATE TABLE IF NOT EXISTS cache_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)")
         # Seed defaults if empty
         cur.execute("SELECT COUNT(*) FROM spg_options");
         if cur.fetchone()[0] == 0:
@@ -151,22 +304,119 @@ ensure_option_tables()
 
 # Helpers
 
+def get_db():
+    # One pooled DBAPI connection per request (app context), shared by the view and every
+    # helper it calls; returned to the pool in close_db
+    if 'db_conn' not in g:
+        g.db_conn = engine.raw_connection()
+    return g.db_conn
+
+@app.teardown_appcontext
+def close_db(exc):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        conn.close()
+
+# Request metrics, kept in memory per worker process: cumulative latency histograms and
+# SQL totals per endpoint, plus a window of recent latencies for the percentiles
+REQUEST_LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+REQUEST_METRICS_WINDOW = int(os.environ.get('REQUEST_METRICS_WINDOW', '1000'))
+# SQL statements one request may run before a warning is logged; 0 disables
+QUERY_BUDGET = int(os.environ.get('QUERY_BUDGET', '40'))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+_route_metrics = {}
+_route_metrics_lock = threading.Lock()
+
+@app.before_request
+def start_request_metrics():
+    g._request_metrics = (time.perf_counter(), SqlStats())
+    _sql_stats.set(g._request_metrics[1])
+
+@app.after_request
+def note_response_metrics(response):
+    g._response_failed = response.status_code >= 500
+    # teardown_request runs as soon as the view returns, before a generated body (a
+    # streamed export) has run its queries; those are recorded once the response is
+    # closed. send_file responses skip close callbacks but run no SQL while sending.
+    if response.is_streamed and not response.direct_passthrough and '_request_metrics' in g:
+        started, stats = g.pop('_request_metrics')
+        endpoint, method, path = request.endpoint, request.method, request.path
+        response.call_on_close(lambda: record_request_metrics(
+            endpoint, method, path, started, stats, response.status_code >= 500))
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    if '_request_metrics' in g:
+        started, stats = g.pop('_request_metrics')
+        failed = exc is not None or g.get('_response_failed', False)
+        record_request_metrics(request.endpoint, request.method, request.path, started, stats, failed)
+
+def record_request_metrics(endpoint, method, path, started, stats, failed):
+    _sql_stats.set(None)
+    endpoint = endpoint or '<unmatched>'
+    if endpoint == 'static':
+        return
+    ms = (time.perf_counter() - started) * 1000
+    over_budget = QUERY_BUDGET > 0 and stats.statements > QUERY_BUDGET
+    with _route_metrics_lock:
+        m = _route_metrics.get(endpoint)
+        if m is None:
+            m = _route_metrics[endpoint] = {
+                'requests': 0, 'errors': 0, 'seconds': 0.0,
+                'buckets': [0] * (len(REQUEST_LATENCY_BUCKETS_MS) + 1),
+                'recent': deque(maxlen=REQUEST_METRICS_WINDOW),
+                'statements': 0, 'rows': 0, 'sql_seconds': 0.0, 'max_statements': 0, 'over_budget': 0,
+            }
+        m['requests'] += 1
+        m['errors'] += failed
+        m['seconds'] += ms / 1000
+        m['buckets'][bisect.bisect_left(REQUEST_LATENCY_BUCKETS_MS, ms)] += 1
+        m['recent'].append(ms)
+        m['statements'] += stats.statements
+        m['rows'] += stats.rows
+        m['sql_seconds'] += stats.seconds
+        m['max_statements'] = max(m['max_statements'], stats.statements)
+        m['over_budget'] += over_budget
+    if over_budget:
+        app.logger.warning("%s %s ran %d SQL statements (QUERY_BUDGET %d), fetched %d rows, %.1f ms",
+                           method, path, stats.statements, QUERY_BUDGET, stats.rows, ms)
+
 def current_user():
-    if 'user_id' in session:
-        db = SessionLocal()
-        try:
-            return db.query(User).get(session['user_id'])
-        finally:
-            db.close()
-    return None
+    # Loaded at most once per request
+    if 'user_id' not in session:
+        return None
+    if '_user' not in g:
+        # through the request's connection rather than an ORM session, which would check
+        # out a second one; the User is detached but has the same attributes
+        cur = get_db().cursor()
+        cur.execute("SELECT id, username, password_hash, role FROM users WHERE id = ?", (session['user_id'],))
+        row = cur.fetchone()
+        g._user = User(id=row[0], username=row[1], password_hash=row[2], role=row[3]) if row else None
+    return g._user
+
+def user_cache_key(uid):
+    return f"user:{uid}"
+
+def session_revoked():
+    # Editing or deleting a user bumps its cache_versions entry; sessions signed at an
+    # older version are no longer honoured
+    version = current_cache_versions().get(user_cache_key(session['user_id']), 0)
+    return session.get('auth_ver', 0) != version
 
 def login_required(role=None):
     def decorator(fn):
         def wrapper(*args, **kwargs):
-            user = current_user()
-            if not user:
+            # The role comes from the signed session cookie; only the revocation check
+            # touches the database
+            if 'user_id' not in session:
+                return redirect(url_for('login', next=request.path))
+            if session_revoked():
+                session.clear()
+                flash('Your session has expired, please log in again', 'error')
                 return redirect(url_for('login', next=request.path))
-            if role and user.role != role:
+            if role and session.get('role') != role:
                 flash('Unauthorized', 'error')
                 return redirect(url_for('index'))
             return fn(*args, **kwargs)
@@ -174,32 +424,118 @@ def login_required(role=None):
         return wrapper
     return decorator
 
+# In-process cache for the option tables and sales people. Each entry remembers the
+# cache_versions value it was loaded at; writers bump that version in the same
+# transaction, so every worker process reloads on its next read.
+_lookup_cache = {}
+_lookup_lock = threading.Lock()
+
+def read_cache_versions(conn=None):
+    cur = (conn or get_db()).cursor()
+    cur.execute("SELECT name, version FROM cache_versions")
+    return dict(cur.fetchall())
+
+def current_cache_versions():
+    # One version read per request, however many lookups the request makes
+    if not has_app_context():
+        # no g (and so no get_db()) here: use a short-lived connection
+        conn = engine.raw_connection()
+        try:
+            return read_cache_versions(conn)
+        finally:
+            conn.close()
+    if '_cache_versions' not in g:
+        versions = read_cache_versions()
+        if versions.get('schema', 0) != _sale_schema_version:
+            refresh_sale_schema(versions['schema'])
+            # read again so this request's connection also picks up the new schema
+            versions = read_cache_versions()
+        g._cache_versions = versions
+    return g._cache_versions
+
+def bump_cache_version(cur, name):
+    # Call inside the writing transaction, before commit
+    cur.execute(
+        "INSERT INTO cache_versions(name, version) VALUES (?, 1) "
+        "ON CONFLICT(name) DO UPDATE SET version = version + 1",
+        (name,)
+    )
+    with _lookup_lock:
+        _lookup_cache.pop(name, None)
+    if has_app_context():
+        g.pop('_cache_versions', None)
+
+def cached_lookup(name, loader):
+    version = current_cache_versions().get(name, 0)
+    with _lookup_lock:
+        hit = _lookup_cache.get(name)
+    if hit and hit[0] == version:
+        return hit[1]
+    value = loader()
+    with _lookup_lock:
+        _lookup_cache[name] = (version, value)
+    return value
+
+# Conditional GET for read-only pages and exports. Triggers bump the 'data' entry of
+# cache_versions on every sale_details/payments write (see ensure_data_version), so the
+# versions login_required has already read identify the data a response was built from.
+def data_etag():
+    versions = current_cache_versions()
+    key = json.dumps([
+        request.path, sorted(request.args.items(multi=True)), session.get('user_id'),
+        # other users' entries only matter for revocation, which login_required handles
+        sorted((k, v) for k, v in versions.items() if not k.startswith('user:') or k == user_cache_key(session.get('user_id'))),
+        # views default the year filter to the current one
+        datetime.today().strftime('%Y'),
+    ])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def etag_cached(fn):
+    def wrapper(*args, **kwargs):
+        # A page with pending flash messages must render them (and must not be revalidated
+        # into showing them again)
+        if session.get('_flashes'):
+            return fn(*args, **kwargs)
+        tag = data_etag()
+        if request.if_none_match.contains(tag):
+            res = Response(status=304)
+        else:
+            res = make_response(fn(*args, **kwargs))
+        res.set_etag(tag)
+        # let the browser keep the copy but revalidate it on every use
+        res.headers['Cache-Control'] = 'private, no-cache'
+        res.vary.add('Cookie')
+        return res
+    wrapper.__name__ = fn.__name__
+    return wrapper
+
+def _load_column(sql):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(sql)
+    return [r[0] for r in cur.fetchall()]
+
 def get_options(table):
-    conn = engine.raw_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute(f"SELECT value FROM {table} ORDER BY value")
-        return [r[0] for r in cur.fetchall()]
-    finally:
-        conn.close()
+    return cached_lookup(table, lambda: _load_column(f"SELECT value FROM {table} ORDER BY value"))
 
 def get_sales_people_names():
-    conn = engine.raw_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT DISTINCT full_name FROM sales_people ORDER BY full_name")
-        return [r[0] for r in cur.fetchall()]
-    finally:
-        conn.close()
+    return cached_lookup('sales_people', lambda: _load_column("SELECT DISTINCT full_name FROM sales_people ORDER BY full_name"))
 
 def is_valid_option(table, value):
-    conn = engine.raw_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute(f"SELECT 1 FROM {table} WHERE value = ?", (value,))
-        return cur.fetchone() is not None
-    finally:
-        conn.close()
+    return value in get_options(table)
+
+def next_sale_sno(cur):
+    # Allocate inside the caller's insert transaction: the UPDATE takes SQLite's write
+    # lock, so concurrent saves queue (busy_timeout) instead of reading the same value
+    cur.execute("UPDATE sequences SET value = value + 1 WHERE name = 'sale_s_no'")
+    cur.execute("SELECT value FROM sequences WHERE name = 'sale_s_no'")
+    return cur.fetchone()[0]
+
+def peek_sale_sno(cur):
+    # Preview for the new-sale forms; the number actually saved comes from next_sale_sno
+    cur.execute("SELECT value + 1 FROM sequences WHERE name = 'sale_s_no'")
+    row = cur.fetchone()
+    return row[0] if row else 1
 
 def clean_number(val):
     return float(re.sub(r"[^0-9.-]", "", (val or '0'))) if re.sub(r"[^0-9.-]", "", (val or '')) != '' else 0.0
@@ -212,6 +548,300 @@ def format_currency_csv(n):
     # Use ASCII dollar to avoid encoding issues across viewers
     return f"$ {x:,.2f}"
 
+# Column list shared by the dashboard table, CSV and XLSX exports (same order as the headers)
+SALE_EXPORT_COLUMNS = (
+    "s_no, booking_date, project, spg_praneeth, token, buyer_name, sale_person_name, crm_name, sol, "
+    "type_of_sale, land_sqyards, sbua_sqft, facing, base_sqft_price, amenties_and_premiums, "
+    "total_sale_price, amount_received, balance_amount, balance_tobe_received_by_plan_approval, notes, "
+    "balance_tobe_received_during_exec"
+)
+
+EXPORT_HEADERS = [
+    'S.No','Booking Date','Project','SPG/Praneeth','Token','Buyer Name','Sale Person Name','CRM Name','SOL',
+    'Type of Sale','Land (sq yards)','SBUA (sq feet)','Facing','Base sq ft price','Amenities and Premiums',
+    'Total Sale Price','Amount Received','Balance Amount','Balance to be received by plan approval','Notes',
+    'Balance to be received during execution'
+]
+EXPORT_FIELDS = [c.strip() for c in SALE_EXPORT_COLUMNS.split(',')]
+# currency fields by index in SALE_EXPORT_COLUMNS: 13,14,15,16,17,18,20
+EXPORT_CURRENCY_IDX = (13, 14, 15, 16, 17, 18, 20)
+EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', '500'))
+
+def iter_query_chunks(query, params, chunk_size=EXPORT_CHUNK_ROWS):
+    # Yield result rows in fetchmany() chunks so callers never hold the full result set
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(query, tuple(params))
+    while True:
+        chunk = cur.fetchmany(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+def iter_export_csv(query, params):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_HEADERS)
+    yield buf.getvalue().encode('utf-8')
+    for chunk in iter_query_chunks(query, params):
+        buf.seek(0)
+        buf.truncate(0)
+        for r in chunk:
+            r = list(r)
+            for idx in EXPORT_CURRENCY_IDX:
+                r[idx] = format_currency_csv(r[idx])
+            writer.writerow(r)
+        yield buf.getvalue().encode('utf-8')
+
+def iter_export_jsonl(query, params):
+    for chunk in iter_query_chunks(query, params):
+        yield ''.join(json.dumps(dict(zip(EXPORT_FIELDS, r)), default=str) + '\n' for r in chunk).encode('utf-8')
+
+# Disk cache of finished export files, keyed by format, filters and the data version
+# (see ensure_data_version), so a key never goes stale: new data means new keys. Files
+# are written under a .tmp name and renamed into place, so readers only ever see
+# complete files. Least recently used files are removed beyond EXPORT_CACHE_MAX_MB;
+# 0 disables the cache.
+EXPORT_CACHE_DIR = os.environ.get('EXPORT_CACHE_DIR', os.path.join(os.path.dirname(DB_PATH), 'export_cache'))
+EXPORT_CACHE_MAX_BYTES = int(float(os.environ.get('EXPORT_CACHE_MAX_MB', '256')) * 1024 * 1024)
+EXPORT_CACHE_TMP_MAX_AGE = 3600
+
+def data_version():
+    return current_cache_versions().get('data', 0)
+
+def export_cache_path(fmt, filters, version):
+    key = hashlib.sha256(json.dumps([fmt, *filters, version]).encode('utf-8')).hexdigest()
+    return os.path.join(EXPORT_CACHE_DIR, f'{key}.{fmt}')
+
+def open_cached_export(path):
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    try:
+        # mtime is the LRU clock
+        os.utime(path)
+    except OSError:
+        pass
+    return f
+
+def new_export_tempfile():
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    return tempfile.NamedTemporaryFile(dir=EXPORT_CACHE_DIR, suffix='.tmp', delete=False)
+
+def publish_export(tmp_path, path, version):
+    # Rename a finished temp file into the cache. Returns False (leaving the temp file to
+    # the caller) if the data changed while it was being written: its rows may be newer
+    # than `version`.
+    cur = get_db().cursor()
+    cur.execute("SELECT version FROM cache_versions WHERE name = 'data'")
+    row = cur.fetchone()
+    if (row[0] if row else 0) != version:
+        return False
+    os.replace(tmp_path, path)
+    prune_export_cache()
+    return True
+
+def prune_export_cache():
+    entries, total, now = [], 0, time.time()
+    try:
+        with os.scandir(EXPORT_CACHE_DIR) as it:
+            for e in it:
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue
+                if e.name.endswith('.tmp'):
+                    # left behind by a crashed worker
+                    if now - st.st_mtime > EXPORT_CACHE_TMP_MAX_AGE:
+                        try:
+                            os.remove(e.path)
+                        except OSError:
+                            pass
+                    continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+                total += st.st_size
+    except FileNotFoundError:
+        return
+    entries.sort()
+    for _, size, path in entries:
+        if total <= EXPORT_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            # in use elsewhere (Windows) or already removed by another worker
+            continue
+        total -= size
+
+def tee_export(chunks, path, version):
+    # Pass the streamed export through to the client and into the cache; a download
+    # cut short is discarded
+    tmp = new_export_tempfile()
+    complete = False
+    try:
+        for chunk in chunks:
+            tmp.write(chunk)
+            yield chunk
+        complete = True
+    finally:
+        tmp.close()
+        if not (complete and publish_export(tmp.name, path, version)):
+            os.remove(tmp.name)
+
+def export_response(query, params, fmt, basename, cache_filters=None):
+    # Stream the export chunk by chunk: flat memory, first bytes sent before the query
+    # finishes. With cache_filters, a repeat of the same export is served from disk.
+    if fmt == 'jsonl':
+        body, mimetype, ext = iter_export_jsonl(query, params), 'application/x-ndjson', 'jsonl'
+    else:
+        body, mimetype, ext = iter_export_csv(query, params), 'text/csv', 'csv'
+    ts = datetime.today().strftime('%Y%m%d-%H%M%S')
+    download_name = f'{basename}_{ts}.{ext}'
+    if cache_filters is not None and EXPORT_CACHE_MAX_BYTES > 0:
+        version = data_version()
+        path = export_cache_path(ext, cache_filters, version)
+        f = open_cached_export(path)
+        if f:
+            return send_file(f, mimetype=mimetype, as_attachment=True, download_name=download_name)
+        body = tee_export(body, path, version)
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={download_name}'})
+
+def booking_date_bounds(year, month=None):
+    # Half-open [start, end) ISO date range for a year or a year+month, or None when
+    # the input isn't a usable year. Comparing booking_date against these bounds lets
+    # SQLite use the booking_date indexes, unlike strftime() on the column.
+    try:
+        y = int(year)
+    except (TypeError, ValueError):
+        return None
+    if not (1 <= y <= 9998):
+        return None
+    if month:
+        try:
+            m = int(month)
+        except (TypeError, ValueError):
+            return None
+        if not (1 <= m <= 12):
+            return None
+        start = f"{y:04d}-{m:02d}-01"
+        end = f"{y + 1:04d}-01-01" if m == 12 else f"{y:04d}-{m + 1:02d}-01"
+        return start, end
+    return f"{y:04d}-01-01", f"{y + 1:04d}-01-01"
+
+def admin_filter_sql(month, year, crm, sp, spg, tos):
+    # WHERE fragment (starting with " AND") and params for the admin dashboard/export filters
+    clause, params = '', []
+    bounds = booking_date_bounds(year, month) if year else None
+    if bounds:
+        clause += " AND booking_date >= ? AND booking_date < ?"; params += list(bounds)
+    else:
+        # Month across all years (or malformed input) can't be a single range
+        if year:
+            clause += " AND strftime('%Y', booking_date) = ?"; params.append(year)
+        if month:
+            clause += " AND strftime('%m', booking_date) = ?"; params.append(month.zfill(2))
+    if crm:
+        clause += " AND crm_name = ?"; params.append(crm)
+    if sp:
+        clause += " AND sale_person_name = ?"; params.append(sp)
+    if spg:
+        clause += " AND spg_praneeth = ?"; params.append(spg)
+    if tos:
+        clause += " AND type_of_sale = ?"; params.append(tos)
+    return clause, params
+
+# Keyset (cursor) pagination: pages are addressed by the sort-key values of their
+# first/last row, so fetching page N costs the same as page 1.
+PAGE_SIZES = (10, 25, 50, 100, 200)
+
+def sale_sort_keys(col, dir_sql):
+    # (expression, direction) pairs for a list ordering; rowid makes every ordering total
+    if col == 'booking_date' and dir_sql == 'DESC':
+        # keep NULL dates last when sorting by date desc
+        return [('(booking_date IS NULL)', 'ASC'), ('booking_date', 'DESC'), ('s_no', 'DESC'), ('rowid', 'DESC')]
+    return [(col, dir_sql), ('rowid', dir_sql)]
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(token, size):
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8'))
+    except Exception:
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    return values
+
+def keyset_after_sql(keys, values):
+    # Predicate matching rows strictly after `values` in the given ordering (SQLite sorts NULL lowest)
+    ors, params = [], []
+    for i, (expr, direction) in enumerate(keys):
+        parts, part_params = [], []
+        for (prev_expr, _), prev_val in zip(keys[:i], values[:i]):
+            parts.append(f"{prev_expr} IS ?"); part_params.append(prev_val)
+        val = values[i]
+        if direction == 'ASC':
+            if val is None:
+                parts.append(f"{expr} IS NOT NULL")
+            else:
+                parts.append(f"{expr} > ?"); part_params.append(val)
+        else:
+            if val is None:
+                continue  # nothing sorts after NULL when descending
+            parts.append(f"({expr} < ? OR {expr} IS NULL)"); part_params.append(val)
+        ors.append('(' + ' AND '.join(parts) + ')')
+        params += part_params
+    return ('(' + ' OR '.join(ors) + ')' if ors else '0'), params
+
+def fetch_keyset_page(cur, columns_sql, from_where_sql, params, keys, limit, after=None, before=None):
+    # from_where_sql is "FROM ... WHERE ..."; returns (rows as dicts, next_cursor, prev_cursor, total)
+    params = list(params)
+    cur.execute(f"SELECT COUNT(*) {from_where_sql}", tuple(params))
+    total = cur.fetchone()[0]
+    before_vals = decode_cursor(before, len(keys))
+    after_vals = None if before_vals else decode_cursor(after, len(keys))
+    order_keys = keys
+    if before_vals:
+        # Walk backwards from the cursor, then flip the page back into display order
+        order_keys = [(e, 'ASC' if d == 'DESC' else 'DESC') for e, d in keys]
+    sql = f"SELECT {columns_sql}, " + ', '.join(f"{e} AS _k{i}" for i, (e, _) in enumerate(keys)) + f" {from_where_sql}"
+    cursor_vals = before_vals or after_vals
+    if cursor_vals:
+        pred, pred_params = keyset_after_sql(order_keys, cursor_vals)
+        sql += f" AND {pred}"; params += pred_params
+    sql += " ORDER BY " + ', '.join(f"{e} {d}" for e, d in order_keys) + " LIMIT ?"
+    params.append(limit + 1)
+    cur.execute(sql, tuple(params))
+    cols = [d[0] for d in cur.description]
+    rows = [dict(zip(cols, r)) for r in cur.fetchall()]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before_vals:
+        rows.reverse()
+    key_of = lambda rec: encode_cursor([rec[f'_k{i}'] for i in range(len(keys))])
+    first_cursor = key_of(rows[0]) if rows else None
+    last_cursor = key_of(rows[-1]) if rows else None
+    for rec in rows:
+        for i in range(len(keys)):
+            rec.pop(f'_k{i}', None)
+    if before_vals:
+        next_cursor, prev_cursor = last_cursor, (first_cursor if has_more else None)
+    else:
+        next_cursor, prev_cursor = (last_cursor if has_more else None), (first_cursor if after_vals else None)
+    return rows, next_cursor, prev_cursor, total
+
+def page_size_arg(name, default):
+    try:
+        size = int(request.args.get(name) or default)
+    except (TypeError, ValueError):
+        size = default
+    return size if size in PAGE_SIZES else default
+
 def compute_totals(base, prem, sbua, received, tos):
     # Total Sale Price = SBUA * Base Sq Ft Price (exclude amenities/premiums from total)
     total = (base or 0) * (sbua or 0)
@@ -227,6 +857,104 @@ def compute_totals(base, prem, sbua, received, tos):
         during_exec = max(balance - by_plan, 0.0)
     return total, balance, by_plan, during_exec
 
+# Bulk recompute/verify of the derived columns with the web app's formulas. Rows written
+# by the import scripts or before a formula change can disagree with compute_totals;
+# this walks sale_details in rowid batches, reports every drifted value and, unless it
+# is a dry run, rewrites them, all in the caller's transaction.
+# sbua_sqft is an input (typed in, or loaded from the sheet), not derived from land
+DERIVED_COLUMNS = ('total_sale_price', 'balance_amount',
+                   'balance_tobe_received_by_plan_approval', 'balance_tobe_received_during_exec')
+RECOMPUTE_BATCH_ROWS = int(os.environ.get('RECOMPUTE_BATCH_ROWS', '2000'))
+RECOMPUTE_TOLERANCE = 0.005
+RECOMPUTE_SAMPLES = 20
+
+def stored_number(v):
+    # Values saved straight from forms may be text such as "1,50,000"
+    if v is None:
+        return 0.0
+    if isinstance(v, (int, float)):
+        return float(v)
+    return clean_number(str(v))
+
+def derived_values(sbua, base, prem, received, payments_total, tos):
+    # Same rules as the create/edit/add-payment routes, from the stored SBUA; balances
+    # count the payments made so far
+    return compute_totals(
+        stored_number(base), stored_number(prem), stored_number(sbua),
+        stored_number(received) + stored_number(payments_total), tos)
+
+def recompute_derived(cur, apply=False, batch_rows=RECOMPUTE_BATCH_ROWS):
+    report = {
+        'applied': apply, 'rows': 0, 'drifted_rows': 0,
+        'columns': {c: {'rows': 0, 'net': 0.0, 'abs': 0.0, 'max_abs': 0.0} for c in DERIVED_COLUMNS},
+        'samples': [],
+    }
+    update_sql = f"UPDATE sale_details SET {', '.join(f'{c} = ?' for c in DERIVED_COLUMNS)} WHERE rowid = ?"
+    last_rowid = 0
+    while True:
+        cur.execute(
+            "SELECT rowid, s_no, sbua_sqft, base_sqft_price, amenties_and_premiums, amount_received, "
+            f"payments_total, type_of_sale, {', '.join(DERIVED_COLUMNS)} "
+            "FROM sale_details WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (last_rowid, batch_rows)
+        )
+        rows = cur.fetchall()
+        if not rows:
+            break
+        updates = []
+        for rowid, s_no, sbua, base, prem, received, paid, tos, *stored in rows:
+            new = derived_values(sbua, base, prem, received, paid, tos)
+            drift = {}
+            for col, old_v, new_v in zip(DERIVED_COLUMNS, stored, new):
+                diff = new_v - stored_number(old_v)
+                if abs(diff) > RECOMPUTE_TOLERANCE:
+                    drift[col] = (old_v, round(new_v, 2))
+                    stats = report['columns'][col]
+                    stats['rows'] += 1
+                    stats['net'] += diff
+                    stats['abs'] += abs(diff)
+                    stats['max_abs'] = max(stats['max_abs'], abs(diff))
+            if drift:
+                report['drifted_rows'] += 1
+                if len(report['samples']) < RECOMPUTE_SAMPLES:
+                    report['samples'].append({'rowid': rowid, 's_no': s_no, 'changes': drift})
+                updates.append(new + (rowid,))
+        if apply and updates:
+            cur.executemany(update_sql, updates)
+        report['rows'] += len(rows)
+        last_rowid = rows[-1][0]
+    for stats in report['columns'].values():
+        for k in ('net', 'abs', 'max_abs'):
+            stats[k] = round(stats[k], 2)
+    return report
+
+def print_recompute_report(report):
+    verb = 'rewritten' if report['applied'] else 'would be rewritten'
+    print(f"{report['rows']} rows checked, {report['drifted_rows']} drifted ({verb})")
+    print(f"{'column':<42} {'rows':>7} {'net diff':>16} {'abs diff':>16} {'max diff':>14}")
+    for col, st in report['columns'].items():
+        print(f"{col:<42} {st['rows']:>7} {st['net']:>16,.2f} {st['abs']:>16,.2f} {st['max_abs']:>14,.2f}")
+    for sample in report['samples']:
+        changes = ', '.join(f"{c}: {o!r} -> {n}" for c, (o, n) in sample['changes'].items())
+        print(f"  rowid {sample['rowid']} (s_no {sample['s_no']}): {changes}")
+
+@app.cli.command('recompute-derived')
+@click.option('--apply', is_flag=True, help='Rewrite drifted rows (default: dry run, report only).')
+@click.option('--batch-rows', default=RECOMPUTE_BATCH_ROWS, show_default=True, help='Rows read per batch.')
+def recompute_derived_command(apply, batch_rows):
+    """Check total/balance columns against compute_totals (payments included) and optionally fix them."""
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        report = recompute_derived(cur, apply=apply, batch_rows=batch_rows)
+        if apply:
+            conn.commit()
+        else:
+            conn.rollback()
+    finally:
+        conn.close()
+    print_recompute_report(report)
+
 # Payments table
 def ensure_payments_table():
     conn = engine.raw_connection()
@@ -243,12 +971,391 @@ def ensure_payments_table():
             )
             """
         )
+        # Per-sale payment lookups/aggregates are served by this index
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_payments_sale_rowid ON payments(sale_rowid)")
+        # Persisted payments rollup on each sale, kept current by the triggers below
+        cur.execute("PRAGMA table_info(sale_details)")
+        existing = {r[1] for r in cur.fetchall()}
+        added = False
+        for col, decl in (('payments_total', 'REAL NOT NULL DEFAULT 0'),
+                          ('payments_count', 'INTEGER NOT NULL DEFAULT 0'),
+                          ('last_paid_date', 'TEXT')):
+            if col not in existing:
+                cur.execute(f"ALTER TABLE sale_details ADD COLUMN {col} {decl}")
+                added = True
+        if added:
+            # One-shot backfill from existing payment history
+            cur.execute(
+                """
+                UPDATE sale_details SET
+                    payments_total = COALESCE((SELECT SUM(amount) FROM payments WHERE sale_rowid = sale_details.rowid), 0),
+                    payments_count = (SELECT COUNT(*) FROM payments WHERE sale_rowid = sale_details.rowid),
+                    last_paid_date = (SELECT MAX(paid_date) FROM payments WHERE sale_rowid = sale_details.rowid)
+                """
+            )
+        cur.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_payments_rollup_insert AFTER INSERT ON payments
+            BEGIN
+                UPDATE sale_details SET
+                    payments_total = COALESCE(payments_total, 0) + COALESCE(NEW.amount, 0),
+                    payments_count = COALESCE(payments_count, 0) + 1,
+                    last_paid_date = CASE WHEN last_paid_date IS NULL OR NEW.paid_date > last_paid_date
+                                          THEN NEW.paid_date ELSE last_paid_date END
+                WHERE rowid = NEW.sale_rowid;
+            END
+            """
+        )
+        cur.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_payments_rollup_delete AFTER DELETE ON payments
+            BEGIN
+                UPDATE sale_details SET
+                    payments_total = COALESCE(payments_total, 0) - COALESCE(OLD.amount, 0),
+                    payments_count = MAX(COALESCE(payments_count, 0) - 1, 0),
+                    last_paid_date = (SELECT MAX(paid_date) FROM payments WHERE sale_rowid = OLD.sale_rowid)
+                WHERE rowid = OLD.sale_rowid;
+            END
+            """
+        )
+        cur.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_payments_rollup_update AFTER UPDATE OF sale_rowid, paid_date, amount ON payments
+            BEGIN
+                UPDATE sale_details SET
+                    payments_total = COALESCE(payments_total, 0) - COALESCE(OLD.amount, 0),
+                    payments_count = MAX(COALESCE(payments_count, 0) - 1, 0),
+                    last_paid_date = (SELECT MAX(paid_date) FROM payments WHERE sale_rowid = OLD.sale_rowid)
+                WHERE rowid = OLD.sale_rowid;
+                UPDATE sale_details SET
+                    payments_total = COALESCE(payments_total, 0) + COALESCE(NEW.amount, 0),
+                    payments_count = COALESCE(payments_count, 0) + 1,
+                    last_paid_date = (SELECT MAX(paid_date) FROM payments WHERE sale_rowid = NEW.sale_rowid)
+                WHERE rowid = NEW.sale_rowid;
+            END
+            """
+        )
         conn.commit()
     finally:
         conn.close()
 
 ensure_payments_table()
 
+# Monthly reporting rollup of sale_details, keyed by (year-month, CRM, sales person, SPG,
+# type of sale) with NULLs stored as ''. Triggers on sale_details keep it current for
+# every insert/edit/delete, and payments reach it through the payments_total update.
+ROLLUP_KEYS = (
+    ('ym', "COALESCE(substr({r}.booking_date, 1, 7), '')"),
+    ('crm_name', "COALESCE({r}.crm_name, '')"),
+    ('sale_person_name', "COALESCE({r}.sale_person_name, '')"),
+    ('spg_praneeth', "COALESCE({r}.spg_praneeth, '')"),
+    ('type_of_sale', "COALESCE({r}.type_of_sale, '')"),
+)
+ROLLUP_MEASURES = (
+    ('sales', "1"),
+    ('total_sale_price', "COALESCE({r}.total_sale_price, 0)"),
+    ('amount_received', "COALESCE({r}.amount_received, 0) + COALESCE({r}.payments_total, 0)"),
+    ('balance_amount', "COALESCE({r}.balance_amount, 0)"),
+    ('plan_approval_dues', "COALESCE({r}.balance_tobe_received_by_plan_approval, 0)"),
+    ('execution_dues', "COALESCE({r}.balance_tobe_received_during_exec, 0)"),
+)
+ROLLUP_SOURCE_COLUMNS = ('booking_date', 'crm_name', 'sale_person_name', 'spg_praneeth', 'type_of_sale',
+                         'total_sale_price', 'amount_received', 'payments_total', 'balance_amount',
+                         'balance_tobe_received_by_plan_approval', 'balance_tobe_received_during_exec')
+
+def rollup_add_sql(r):
+    keys = ', '.join(k for k, _ in ROLLUP_KEYS)
+    return (
+        f"INSERT INTO sales_monthly_rollup ({keys}, {', '.join(m for m, _ in ROLLUP_MEASURES)}) "
+        f"VALUES ({', '.join(e.format(r=r) for _, e in ROLLUP_KEYS + ROLLUP_MEASURES)}) "
+        f"ON CONFLICT ({keys}) DO UPDATE SET {', '.join(f'{m} = {m} + excluded.{m}' for m, _ in ROLLUP_MEASURES)};"
+    )
+
+def rollup_remove_sql(r):
+    match = ' AND '.join(f"{k} = {e.format(r=r)}" for k, e in ROLLUP_KEYS)
+    return (
+        f"UPDATE sales_monthly_rollup SET {', '.join(f'{m} = {m} - ({e.format(r=r)})' for m, e in ROLLUP_MEASURES)} WHERE {match}; "
+        f"DELETE FROM sales_monthly_rollup WHERE {match} AND sales <= 0;"
+    )
+
+def rebuild_sales_rollup(cur):
+    cur.execute("DELETE FROM sales_monthly_rollup")
+    cur.execute(
+        f"INSERT INTO sales_monthly_rollup ({', '.join(k for k, _ in ROLLUP_KEYS + ROLLUP_MEASURES)}) "
+        f"SELECT {', '.join(e.format(r='s') for _, e in ROLLUP_KEYS)}, "
+        f"{', '.join('SUM(' + e.format(r='s') + ')' for _, e in ROLLUP_MEASURES)} "
+        f"FROM sale_details s GROUP BY {', '.join(str(i + 1) for i in range(len(ROLLUP_KEYS)))}"
+    )
+
+def ensure_sales_rollup():
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS sales_monthly_rollup (
+                {', '.join(f"{k} TEXT NOT NULL" for k, _ in ROLLUP_KEYS)},
+                sales INTEGER NOT NULL DEFAULT 0,
+                {', '.join(f"{m} REAL NOT NULL DEFAULT 0" for m, _ in ROLLUP_MEASURES[1:])},
+                PRIMARY KEY ({', '.join(k for k, _ in ROLLUP_KEYS)})
+            )
+            """
+        )
+        cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_sale_details_rollup_insert AFTER INSERT ON sale_details BEGIN {rollup_add_sql('NEW')} END")
+        cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_sale_details_rollup_delete AFTER DELETE ON sale_details BEGIN {rollup_remove_sql('OLD')} END")
+        cur.execute(
+            f"CREATE TRIGGER IF NOT EXISTS trg_sale_details_rollup_update AFTER UPDATE OF {', '.join(ROLLUP_SOURCE_COLUMNS)} ON sale_details "
+            f"BEGIN {rollup_remove_sql('OLD')} {rollup_add_sql('NEW')} END"
+        )
+        # (Re)build when it is missing or out of step, e.g. after the import scripts
+        # replaced sale_details wholesale
+        cur.execute("SELECT COALESCE(SUM(sales), 0) FROM sales_monthly_rollup")
+        rolled = cur.fetchone()[0]
+        cur.execute("SELECT COUNT(*) FROM sale_details")
+        if rolled != cur.fetchone()[0]:
+            rebuild_sales_rollup(cur)
+        conn.commit()
+    finally:
+        conn.close()
+
+ensure_sales_rollup()
+
+def ensure_data_version():
+    # Any sale or payment write bumps cache_versions 'data' in the writer's own
+    # transaction (see etag_cached)
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("INSERT OR IGNORE INTO cache_versions(name, version) VALUES ('data', 0)")
+        for table in ('sale_details', 'payments'):
+            for op in ('INSERT', 'UPDATE', 'DELETE'):
+                cur.execute(
+                    f"CREATE TRIGGER IF NOT EXISTS trg_{table}_data_version_{op.lower()} AFTER {op} ON {table} "
+                    "BEGIN UPDATE cache_versions SET version = version + 1 WHERE name = 'data'; END"
+                )
+        conn.commit()
+    finally:
+        conn.close()
+
+ensure_data_version()
+
+# Full-text search over the free-text columns: an FTS5 index that stores only the index
+# (content='sale_details'), kept in step by triggers. Terms are prefix-matched, so
+# "rav kum" finds "Ravi Kumar". Without FTS5 in this SQLite build, search_sql() falls
+# back to LIKE.
+SEARCH_COLUMNS = ('buyer_name', 'project', 'sol', 'notes', 'sale_person_name')
+SEARCH_MAX_TERMS = 8
+
+def ensure_search_index():
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        cols = ', '.join(SEARCH_COLUMNS)
+        cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'sale_details_fts'")
+        exists = cur.fetchone() is not None
+        try:
+            cur.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS sale_details_fts USING fts5({cols}, "
+                "content='sale_details', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+            )
+        except sqlite3.OperationalError as e:
+            print(f"WARNING: full-text search unavailable ({e}); search will use LIKE")
+            return False
+        # NB: SQLite 3.40 fails an INSERT with "no such table" if it is the first statement
+        # on a connection whose schema another connection has changed and the table has
+        # this trigger plus an older AFTER INSERT one. Requests are safe because
+        # login_required reads cache_versions first; scripts should read before writing.
+        new_vals = ', '.join(f"NEW.{c}" for c in SEARCH_COLUMNS)
+        old_vals = ', '.join(f"OLD.{c}" for c in SEARCH_COLUMNS)
+        remove = f"INSERT INTO sale_details_fts(sale_details_fts, rowid, {cols}) VALUES ('delete', OLD.rowid, {old_vals});"
+        add = f"INSERT INTO sale_details_fts(rowid, {cols}) VALUES (NEW.rowid, {new_vals});"
+        cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_sale_details_fts_insert AFTER INSERT ON sale_details BEGIN {add} END")
+        cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_sale_details_fts_delete AFTER DELETE ON sale_details BEGIN {remove} END")
+        cur.execute(f"CREATE TRIGGER IF NOT EXISTS trg_sale_details_fts_update AFTER UPDATE OF {cols} ON sale_details BEGIN {remove} {add} END")
+        if not exists:
+            # first start, or the import scripts dropped it along with sale_details
+            cur.execute("INSERT INTO sale_details_fts(sale_details_fts) VALUES ('rebuild')")
+        conn.commit()
+        return True
+    finally:
+        conn.close()
+
+SEARCH_FTS = ensure_search_index()
+
+# Typeahead for the free-text sale fields. suggest_terms holds every distinct value with
+# its number of sales, maintained by triggers like sales_monthly_rollup, so /api/suggest
+# is one index range scan. Buyers are scoped to the CRM who owns the sale; projects
+# and sales people are shared ('' scope). Matching ignores case and surrounding spaces.
+SUGGEST_FIELDS = (
+    ('project', "''"),
+    ('buyer_name', "COALESCE({r}.crm_name, '')"),
+    ('sale_person_name', "''"),
+)
+SUGGEST_LIMIT = 10
+
+def suggest_match_sql(f, scope, r):
+    return f"field = '{f}' AND scope = {scope.format(r=r)} AND norm = lower(trim({r}.{f})) AND value = trim({r}.{f})"
+
+def suggest_add_sql(r):
+    # No OR IGNORE here: a conflict clause on the statement that fires the trigger (the
+    # importers' ON CONFLICT(s_no) upsert) overrides the trigger's own, so the insert
+    # must not be able to conflict at all
+    return ' '.join(
+        f"INSERT INTO suggest_terms(field, scope, norm, value, uses) "
+        f"SELECT '{f}', {scope.format(r=r)}, lower(trim({r}.{f})), trim({r}.{f}), 0 "
+        f"WHERE {r}.{f} IS NOT NULL AND trim({r}.{f}) != '' "
+        f"AND NOT EXISTS (SELECT 1 FROM suggest_terms WHERE {suggest_match_sql(f, scope, r)}); "
+        f"UPDATE suggest_terms SET uses = uses + 1 WHERE {suggest_match_sql(f, scope, r)};"
+        for f, scope in SUGGEST_FIELDS
+    )
+
+def suggest_remove_sql(r):
+    sql = []
+    for f, scope in SUGGEST_FIELDS:
+        match = suggest_match_sql(f, scope, r)
+        sql.append(f"UPDATE suggest_terms SET uses = uses - 1 WHERE {match}; DELETE FROM suggest_terms WHERE {match} AND uses <= 0;")
+    return ' '.join(sql)
+
+def replace_trigger(cur, name, definition):
+    # CREATE TRIGGER IF NOT EXISTS would keep an older body forever; sqlite_master keeps
+    # the text after the name verbatim, so a changed definition is dropped and recreated
+    sql = f"CREATE TRIGGER {name} {definition}"
+    cur.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?", (name,))
+    row = cur.fetchone()
+    if row and row[0] == sql:
+        return
+    cur.execute(f"DROP TRIGGER IF EXISTS {name}")
+    cur.execute(sql)
+
+def ensure_suggest_terms():
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'suggest_terms'")
+        exists = cur.fetchone() is not None
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS suggest_terms (
+                field TEXT NOT NULL,
+                scope TEXT NOT NULL,
+                norm TEXT NOT NULL,
+                value TEXT NOT NULL CHECK (value != ''),
+                uses INTEGER NOT NULL,
+                PRIMARY KEY (field, scope, norm, value)
+            ) WITHOUT ROWID
+            """
+        )
+        # admins look up buyers across every CRM
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_suggest_terms_norm ON suggest_terms(field, norm, value)")
+        cols = ', '.join(f for f, _ in SUGGEST_FIELDS)
+        replace_trigger(cur, 'trg_sale_details_suggest_insert', f"AFTER INSERT ON sale_details BEGIN {suggest_add_sql('NEW')} END")
+        replace_trigger(cur, 'trg_sale_details_suggest_delete', f"AFTER DELETE ON sale_details BEGIN {suggest_remove_sql('OLD')} END")
+        replace_trigger(
+            cur, 'trg_sale_details_suggest_update',
+            f"AFTER UPDATE OF {cols}, crm_name ON sale_details BEGIN {suggest_remove_sql('OLD')} {suggest_add_sql('NEW')} END"
+        )
+        if not exists:
+            # first start, or the import scripts dropped it along with sale_details
+            for f, scope in SUGGEST_FIELDS:
+                cur.execute(
+                    f"INSERT INTO suggest_terms(field, scope, norm, value, uses) "
+                    f"SELECT '{f}', {scope.format(r='s')}, lower(trim(s.{f})), trim(s.{f}), COUNT(*) "
+                    f"FROM sale_details s WHERE trim(s.{f}) != '' GROUP BY 2, 3, 4"
+                )
+        conn.commit()
+    finally:
+        conn.close()
+
+ensure_suggest_terms()
+
+# A full reload by the import scripts drops sale_details, and with it everything the
+# ensure_* steps above add to it, then bumps cache_versions 'schema' (see
+# create_sales_database.forget_app_schema). The first request to read a new value
+# re-runs those steps, so a running app needs no restart after a reload.
+def ensure_sale_schema():
+    global SEARCH_FTS
+    init_sqlite_schema()
+    ensure_payments_table()
+    ensure_sales_rollup()
+    ensure_data_version()
+    SEARCH_FTS = ensure_search_index()
+    ensure_suggest_terms()
+
+def read_schema_version():
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT version FROM cache_versions WHERE name = 'schema'")
+        row = cur.fetchone()
+        return row[0] if row else 0
+    finally:
+        conn.close()
+
+_sale_schema_version = read_schema_version()
+_sale_schema_lock = threading.Lock()
+
+def refresh_sale_schema(version):
+    global _sale_schema_version
+    with _sale_schema_lock:
+        if version != _sale_schema_version:
+            print(f"sale_details was reloaded (schema version {version}); recreating its indexes, triggers and derived tables")
+            ensure_sale_schema()
+            _sale_schema_version = version
+
+def suggest_values(field, prefix, scope=None, limit=SUGGEST_LIMIT):
+    # [(value, uses)] whose normalised form starts with prefix, in alphabetical order.
+    # The half-open range [prefix, prefix with its last character incremented) keeps
+    # the scan on the index, unlike LIKE with its case rules.
+    norm = prefix.strip().lower()
+    if not norm:
+        return []
+    upper = norm[:-1] + chr(ord(norm[-1]) + 1)
+    cur = get_db().cursor()
+    if scope is None:
+        cur.execute(
+            "SELECT value, SUM(uses) FROM suggest_terms WHERE field = ? AND norm >= ? AND norm < ? "
+            "GROUP BY norm, value ORDER BY norm, value LIMIT ?",
+            (field, norm, upper, limit)
+        )
+    else:
+        cur.execute(
+            "SELECT value, uses FROM suggest_terms WHERE field = ? AND scope = ? AND norm >= ? AND norm < ? "
+            "ORDER BY norm, value LIMIT ?",
+            (field, scope, norm, upper, limit)
+        )
+    return cur.fetchall()
+
+def search_terms(q):
+    return re.findall(r'\w+', q or '')[:SEARCH_MAX_TERMS]
+
+def search_sql(q):
+    # Extra "AND ..." for a sale_details WHERE clause matching every term of q
+    terms = search_terms(q)
+    if not terms:
+        return "", []
+    if SEARCH_FTS:
+        match = ' '.join(f'"{t}"*' for t in terms)
+        return " AND rowid IN (SELECT rowid FROM sale_details_fts WHERE sale_details_fts MATCH ?)", [match]
+    sql, params = "", []
+    for t in terms:
+        sql += " AND (" + " OR ".join(f"{c} LIKE ?" for c in SEARCH_COLUMNS) + ")"
+        params += [f"%{t}%"] * len(SEARCH_COLUMNS)
+    return sql, params
+
+@app.cli.command('rebuild-rollup')
+def rebuild_rollup_command():
+    """Recreate sales_monthly_rollup from sale_details."""
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        rebuild_sales_rollup(cur)
+        conn.commit()
+        cur.execute("SELECT COUNT(*), COALESCE(SUM(sales), 0) FROM sales_monthly_rollup")
+        groups, sales = cur.fetchone()
+        print(f"sales_monthly_rollup rebuilt: {groups} groups covering {sales} sales")
+    finally:
+        conn.close()
+
 @app.route('/')
 def index():
     user = current_user()
@@ -269,6 +1376,7 @@ def login():
             if user and check_password_hash(user.password_hash, password):
                 session['user_id'] = user.id
                 session['role'] = user.role
+                session['auth_ver'] = current_cache_versions().get(user_cache_key(user.id), 0)
                 if user.role == 'ADMIN':
                     return redirect(url_for('admin_dashboard'))
                 return redirect(url_for('crm_new'))
@@ -304,66 +1412,58 @@ def crm_new():
         total_sale_price, balance_amount, by_plan, during_exec = compute_totals(base, prem, sbua, amt_received, tos)
         if errors:
             return jsonify({"ok": False, "errors": errors})
-        # Get next s_no and insert
-        conn = engine.raw_connection()
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT COALESCE(MAX(s_no), 0) + 1 FROM sale_details")
-            next_sno = cur.fetchone()[0]
-            cur.execute(
-                """
-                INSERT INTO sale_details (
-                    s_no, booking_date, project, spg_praneeth, token, buyer_name, sol, type_of_sale,
-                    land_sqyards, sbua_sqft, facing, base_sqft_price, amenties_and_premiums,
-                    total_sale_price, amount_received, balance_amount,
-                    balance_tobe_received_by_plan_approval, notes, balance_tobe_received_during_exec,
-                    sale_person_name, crm_name
-                ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-                """,
-                (
-                    int(next_sno),
-                    data.get('booking_date') or None,
-                    data.get('project'),
-                    spg,
-                    int(data.get('token') or 0) or None,
-                    data.get('buyer_name'),
-                    data.get('sol'),
-                    tos,
-                    int(land) if land else None,
-                    float(sbua) if sbua else None,
-                    data.get('facing'),
-                    float(base) if base else None,
-                    float(prem) if prem else None,
-                    float(total_sale_price),
-                    float(amt_received) if amt_received else None,
-                    float(balance_amount),
-                    float(by_plan),
-                    data.get('notes'),
-                    float(during_exec),
-                    data.get('sale_person_name'),
-                    user.username
-                )
+        # Allocate the next s_no and insert in one transaction
+        conn = get_db()
+        cur = conn.cursor()
+        next_sno = next_sale_sno(cur)
+        cur.execute(
+            """
+            INSERT INTO sale_details (
+                s_no, booking_date, project, spg_praneeth, token, buyer_name, sol, type_of_sale,
+                land_sqyards, sbua_sqft, facing, base_sqft_price, amenties_and_premiums,
+                total_sale_price, amount_received, balance_amount,
+                balance_tobe_received_by_plan_approval, notes, balance_tobe_received_during_exec,
+                sale_person_name, crm_name
+            ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+            """,
+            (
+                int(next_sno),
+                data.get('booking_date') or None,
+                data.get('project'),
+                spg,
+                int(data.get('token') or 0) or None,
+                data.get('buyer_name'),
+                data.get('sol'),
+                tos,
+                int(land) if land else None,
+                float(sbua) if sbua else None,
+                data.get('facing'),
+                float(base) if base else None,
+                float(prem) if prem else None,
+                float(total_sale_price),
+                float(amt_received) if amt_received else None,
+                float(balance_amount),
+                float(by_plan),
+                data.get('notes'),
+                float(during_exec),
+                data.get('sale_person_name'),
+                user.username
             )
-            conn.commit()
-        finally:
-            conn.close()
+        )
+        conn.commit()
         return jsonify({"ok": True, "s_no": int(next_sno)})
     # GET: load options and next s_no
-    conn = engine.raw_connection()
-    spg_opts, tos_opts, next_sno = [], [], 1
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT value FROM spg_options ORDER BY value"); spg_opts = [r[0] for r in cur.fetchall()]
-        cur.execute("SELECT value FROM sale_type_options ORDER BY value"); tos_opts = [r[0] for r in cur.fetchall()]
-        cur.execute("SELECT COALESCE(MAX(s_no), 0) + 1 FROM sale_details"); next_sno = cur.fetchone()[0]
-    finally:
-        conn.close()
+    spg_opts, tos_opts = get_options('spg_options'), get_options('sale_type_options')
+    conn = get_db()
+    cur = conn.cursor()
+    next_sno = peek_sale_sno(cur)
     today = datetime.today().strftime('%Y-%m-%d')
     sale_people = get_sales_people_names()
     return render_template('crm_new.html', user=user, spg_opts=spg_opts, tos_opts=tos_opts, next_sno=next_sno, today=today, sale_people=sale_people)
 
 @app.route('/crm/list')
 @login_required(role='CRM')
+@etag_cached
 def crm_list():
     user = current_user()
     sort_by = request.args.get('sort_by','booking_date')
@@ -375,161 +1475,123 @@ def crm_list():
     }
     col = allowed.get(sort_by, 'booking_date')
     dir_sql = 'DESC' if sort_dir == 'desc' else 'ASC'
-    # keep NULL dates last when sorting by date desc
-    if col == 'booking_date' and dir_sql == 'DESC':
-        order_clause = "(booking_date IS NULL) ASC, booking_date DESC, s_no DESC"
-    else:
-        order_clause = f"{col} {dir_sql}"
-    conn = engine.raw_connection()
+    per_page = page_size_arg('per_page', 50)
+    q = (request.args.get('q') or '').strip()
+    search, search_params = search_sql(q)
+    conn = get_db()
     rows = []
-    try:
-        cur = conn.cursor()
-        cur.execute(f"SELECT rowid, * FROM sale_details WHERE crm_name = ? ORDER BY {order_clause}", (user.username,))
-        cols = [d[0] for d in cur.description]
-        for r in cur.fetchall():
-            rec = dict(zip(cols, r))
-            # Compute effective amount received = initial amount + sum(payments)
-            try:
-                rid = rec.get('rowid')
-                cur.execute("SELECT COALESCE(SUM(amount),0) FROM payments WHERE sale_rowid = ?", (rid,))
-                pay_sum = cur.fetchone()[0] or 0
-            except Exception:
-                pay_sum = 0
-            try:
-                base_received = float(rec.get('amount_received') or 0)
-            except Exception:
-                base_received = 0.0
-            rec['amount_received_effective'] = base_received + (pay_sum or 0)
-            # Compute effective balance = total - effective received
-            try:
-                total = float(rec.get('total_sale_price') or 0)
-            except Exception:
-                total = 0.0
-            rec['balance_amount_effective'] = total - rec['amount_received_effective']
-            rows.append(rec)
-    finally:
-        conn.close()
-    return render_template('crm_list.html', rows=rows, user=user, sort_by=col, sort_dir=dir_sql.lower())
+    cur = conn.cursor()
+    page, next_cursor, prev_cursor, total = fetch_keyset_page(
+        cur, "rowid, *", f"FROM sale_details WHERE crm_name = ?{search}", [user.username] + search_params,
+        sale_sort_keys(col, dir_sql), per_page, request.args.get('after'), request.args.get('before'))
+    for rec in page:
+        # Compute effective amount received = initial amount + sum(payments)
+        pay_sum = rec.get('payments_total') or 0
+        try:
+            base_received = float(rec.get('amount_received') or 0)
+        except Exception:
+            base_received = 0.0
+        rec['amount_received_effective'] = base_received + (pay_sum or 0)
+        # Compute effective balance = total - effective received
+        try:
+            sale_total = float(rec.get('total_sale_price') or 0)
+        except Exception:
+            sale_total = 0.0
+        rec['balance_amount_effective'] = sale_total - rec['amount_received_effective']
+        rows.append(rec)
+    return render_template('crm_list.html', rows=rows, user=user, sort_by=col, sort_dir=dir_sql.lower(),
+                           per_page=per_page, total=total, next_cursor=next_cursor, prev_cursor=prev_cursor,
+                           q=q)
 
 @app.route('/crm/export')
 @login_required(role='CRM')
+@etag_cached
 def crm_export():
     user = current_user()
-    conn = engine.raw_connection()
-    try:
-        cur = conn.cursor()
-        # Same columns/order as Admin dashboard export but filtered to current CRM
-        query = (
-            "SELECT "
-            "s_no, booking_date, project, spg_praneeth, token, buyer_name, sale_person_name, crm_name, sol, "
-            "type_of_sale, land_sqyards, sbua_sqft, facing, base_sqft_price, amenties_and_premiums, "
-            "total_sale_price, amount_received, balance_amount, balance_tobe_received_by_plan_approval, notes, "
-            "balance_tobe_received_during_exec "
-            "FROM sale_details WHERE crm_name = ? ORDER BY (booking_date IS NULL) ASC, booking_date DESC, s_no DESC"
-        )
-        cur.execute(query, (user.username,))
-        rows = cur.fetchall()
-        text = StringIO()
-        writer = csv.writer(text)
-        writer.writerow([
-            'S.No','Booking Date','Project','SPG/Praneeth','Token','Buyer Name','Sale Person Name','CRM Name','SOL',
-            'Type of Sale','Land (sq yards)','SBUA (sq feet)','Facing','Base sq ft price','Amenities and Premiums',
-            'Total Sale Price','Amount Received','Balance Amount','Balance to be received by plan approval','Notes',
-            'Balance to be received during execution'
-        ])
-        for r in rows:
-            r = list(r)
-            # currency fields by index in SELECT: 13,14,15,16,17,18,20
-            for idx in (13,14,15,16,17,18,20):
-                r[idx] = format_currency_csv(r[idx])
-            writer.writerow(r)
-        data = text.getvalue().encode('utf-8')
-        bio = BytesIO(data)
-        bio.seek(0)
-        uname = (user.username if user else 'user')
-        ts = datetime.today().strftime('%Y%m%d-%H%M%S')
-        return send_file(bio, mimetype='text/csv', as_attachment=True, download_name=f'{uname}_my_sales_{ts}.csv')
-    finally:
-        conn.close()
+    # Same columns/order as Admin dashboard export but filtered to current CRM
+    query = (
+        f"SELECT {SALE_EXPORT_COLUMNS} "
+        "FROM sale_details WHERE crm_name = ? ORDER BY (booking_date IS NULL) ASC, booking_date DESC, s_no DESC"
+    )
+    uname = (user.username if user else 'user')
+    return export_response(query, [user.username], request.args.get('format', 'csv'), f'{uname}_my_sales')
 
 @app.route('/crm/edit/<int:rowid>', methods=['GET','POST'])
 @login_required(role='CRM')
 def crm_edit(rowid):
     user = current_user()
-    conn = engine.raw_connection()
-    try:
-        cur = conn.cursor()
-        if request.method == 'POST':
-            data = dict(request.form)
-            # Only allow editable non-calculated fields
-            allowed = ['booking_date','project','spg_praneeth','token','buyer_name','sol','type_of_sale',
-                       'land_sqyards','sbua_sqft','facing','base_sqft_price','amenties_and_premiums',
-                       'amount_received','notes','sale_person_name']
-            sets = []
-            vals = []
-            for k in allowed:
-                if k in data:
-                    sets.append(f"{k}=?")
-                    vals.append(data[k])
-            # Recompute calculated fields (updated formula)
-            base = clean_number(data.get('base_sqft_price'))
-            prem = clean_number(data.get('amenties_and_premiums'))
-            land = clean_number(data.get('land_sqyards'))
-            sbua = land * 13.5
-            amt_received = clean_number(data.get('amount_received'))
-            tos = (data.get('type_of_sale') or '').upper()
-            total_sale_price, balance_amount, by_plan, during_exec = compute_totals(base, prem, sbua, amt_received, tos)
-            sets += ["sbua_sqft=?","total_sale_price=?","balance_amount=?","balance_tobe_received_by_plan_approval=?","balance_tobe_received_during_exec=?"]
-            vals += [sbua, total_sale_price, balance_amount, by_plan, during_exec]
-            # Enforce ownership
-            vals.append(user.username)
-            vals.append(rowid)
-            sql = f"UPDATE sale_details SET {', '.join(sets)} WHERE crm_name = ? AND rowid = ?"
-            cur.execute(sql, tuple(vals))
-            conn.commit()
+    conn = get_db()
+    cur = conn.cursor()
+    if request.method == 'POST':
+        data = dict(request.form)
+        # Only allow editable non-calculated fields
+        allowed = ['booking_date','project','spg_praneeth','token','buyer_name','sol','type_of_sale',
+                   'land_sqyards','sbua_sqft','facing','base_sqft_price','amenties_and_premiums',
+                   'amount_received','notes','sale_person_name']
+        sets = []
+        vals = []
+        for k in allowed:
+            if k in data:
+                sets.append(f"{k}=?")
+                vals.append(data[k])
+        # Recompute calculated fields (updated formula)
+        base = clean_number(data.get('base_sqft_price'))
+        prem = clean_number(data.get('amenties_and_premiums'))
+        land = clean_number(data.get('land_sqyards'))
+        sbua = land * 13.5
+        amt_received = clean_number(data.get('amount_received'))
+        tos = (data.get('type_of_sale') or '').upper()
+        # balances count the payments already recorded, as in the add-payment routes
+        cur.execute("SELECT payments_total FROM sale_details WHERE rowid = ?", (rowid,))
+        paid = cur.fetchone()
+        paid = (paid[0] or 0) if paid else 0
+        total_sale_price, balance_amount, by_plan, during_exec = compute_totals(base, prem, sbua, amt_received + paid, tos)
+        sets += ["sbua_sqft=?","total_sale_price=?","balance_amount=?","balance_tobe_received_by_plan_approval=?","balance_tobe_received_during_exec=?"]
+        vals += [sbua, total_sale_price, balance_amount, by_plan, during_exec]
+        # Enforce ownership
+        vals.append(user.username)
+        vals.append(rowid)
+        sql = f"UPDATE sale_details SET {', '.join(sets)} WHERE crm_name = ? AND rowid = ?"
+        cur.execute(sql, tuple(vals))
+        conn.commit()
+        return redirect(url_for('crm_list'))
+    else:
+        cur.execute("SELECT rowid, * FROM sale_details WHERE crm_name = ? AND rowid = ?", (user.username, rowid))
+        row = cur.fetchone()
+        if not row:
+            flash('Not found or unauthorized', 'error')
             return redirect(url_for('crm_list'))
-        else:
-            cur.execute("SELECT rowid, * FROM sale_details WHERE crm_name = ? AND rowid = ?", (user.username, rowid))
-            row = cur.fetchone()
-            if not row:
-                flash('Not found or unauthorized', 'error')
-                return redirect(url_for('crm_list'))
-            cols = [d[0] for d in cur.description]
-            rec = dict(zip(cols, row))
-            # payments
-            cur.execute("SELECT paid_date, amount, note FROM payments WHERE sale_rowid = ? ORDER BY paid_date DESC, id DESC", (rowid,))
-            payments = cur.fetchall()
-            cur.execute("SELECT COALESCE(SUM(amount),0) FROM payments WHERE sale_rowid = ?", (rowid,))
-            pay_total = cur.fetchone()[0] or 0
-            # Show initial Amount Received as part of history (display only)
-            try:
-                init_amt = float(rec.get('amount_received') or 0)
-            except Exception:
-                init_amt = 0.0
-            if init_amt > 0:
-                payments = [(rec.get('booking_date'), init_amt, 'Initial Amount Received')] + payments
-            sale_people = get_sales_people_names()
-            return render_template('crm_edit.html', row=rec, user=user, payments=payments, payments_total=pay_total, sale_people=sale_people)
-    finally:
-        conn.close()
+        cols = [d[0] for d in cur.description]
+        rec = dict(zip(cols, row))
+        # payments
+        cur.execute("SELECT paid_date, amount, note FROM payments WHERE sale_rowid = ? ORDER BY paid_date DESC, id DESC", (rowid,))
+        payments = cur.fetchall()
+        pay_total = rec.get('payments_total') or 0
+        # Show initial Amount Received as part of history (display only)
+        try:
+            init_amt = float(rec.get('amount_received') or 0)
+        except Exception:
+            init_amt = 0.0
+        if init_amt > 0:
+            payments = [(rec.get('booking_date'), init_amt, 'Initial Amount Received')] + payments
+        sale_people = get_sales_people_names()
+        return render_template('crm_edit.html', row=rec, user=user, payments=payments, payments_total=pay_total, sale_people=sale_people)
 
 @app.route('/crm/delete/<int:rowid>', methods=['POST'])
 @login_required(role='CRM')
 def crm_delete(rowid):
     user = current_user()
-    conn = engine.raw_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute("DELETE FROM sale_details WHERE rowid = ? AND crm_name = ?", (rowid, user.username))
-        conn.commit()
-        flash('Entry deleted', 'success')
-    finally:
-        conn.close()
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM sale_details WHERE rowid = ? AND crm_name = ?", (rowid, user.username))
+    conn.commit()
+    flash('Entry deleted', 'success')
     return redirect(url_for('crm_list'))
 
 # Admin routes
 @app.route('/admin/dashboard')
 @login_required(role='ADMIN')
+@etag_cached
 def admin_dashboard():
     # Filters
     month = request.args.get('month')
@@ -538,161 +1600,753 @@ def admin_dashboard():
     sp = request.args.get('sale_person_name')
     spg = request.args.get('spg_praneeth')
     tos = request.args.get('type_of_sale')
+    conn = get_db()
+    cur = conn.cursor()
+    # Options for dropdowns
+    cur.execute("SELECT DISTINCT crm_name FROM sale_details WHERE crm_name IS NOT NULL ORDER BY crm_name")
+    crm_opts = [r[0] for r in cur.fetchall()]
+    cur.execute("SELECT DISTINCT sale_person_name FROM sale_details WHERE sale_person_name IS NOT NULL ORDER BY sale_person_name")
+    sp_opts = [r[0] for r in cur.fetchall()]
+    spg_opts = get_options('spg_options')
+    tos_opts = get_options('sale_type_options')
+
+    # Detailed rows with all required columns for dashboard order
+    where_sql, params = admin_filter_sql(month, year, crm, sp, spg, tos)
+    # Sorting
+    sort_by = request.args.get('sort_by','booking_date')
+    sort_dir = request.args.get('sort_dir','desc').lower()
+    allowed = {
+        's_no':'s_no','booking_date':'booking_date','project':'project','spg_praneeth':'spg_praneeth','token':'token',
+        'buyer_name':'buyer_name','sale_person_name':'sale_person_name','crm_name':'crm_name','sol':'sol','type_of_sale':'type_of_sale',
+        'land_sqyards':'land_sqyards','sbua_sqft':'sbua_sqft','facing':'facing','base_sqft_price':'base_sqft_price',
+        'amenties_and_premiums':'amenties_and_premiums','total_sale_price':'total_sale_price','amount_received':'amount_received',
+        'balance_amount':'balance_amount','balance_tobe_received_by_plan_approval':'balance_tobe_received_by_plan_approval',
+        'notes':'notes','balance_tobe_received_during_exec':'balance_tobe_received_during_exec'
+    }
+    col = allowed.get(sort_by, 'booking_date')
+    dir_sql = 'DESC' if sort_dir == 'desc' else 'ASC'
+    # rows per page: default 10, allow 25 or 50; further pages via keyset cursors
+    try:
+        limit = int(request.args.get('limit') or 10)
+    except:
+        limit = 10
+    if limit not in (10,25,50):
+        limit = 10
+    q = (request.args.get('q') or '').strip()
+    search, search_params = search_sql(q)
+    rows, next_cursor, prev_cursor, total = fetch_keyset_page(
+        cur, f"rowid, {SALE_EXPORT_COLUMNS}, payments_total", f"FROM sale_details WHERE 1=1{where_sql}{search}", params + search_params,
+        sale_sort_keys(col, dir_sql), limit, request.args.get('after'), request.args.get('before'))
+    data = []
+    for rec in rows:
+        # Compute effective amount received = initial amount + sum(payments)
+        pay_sum = rec.get('payments_total') or 0
+        try:
+            base_received = float(rec.get('amount_received') or 0)
+        except Exception:
+            base_received = 0.0
+        rec['amount_received_effective'] = base_received + (pay_sum or 0)
+        data.append(rec)
+    # Year options: current, current-1, current-2
+    cur_year = int(datetime.today().strftime('%Y'))
+    years = [str(cur_year - i) for i in range(0,3)]
+    return render_template('admin_dashboard.html', data=data, filters={'year':year,'month':month,'crm':crm,'sp':sp,'spg':spg,'tos':tos},
+                           crm_opts=crm_opts, sp_opts=sp_opts, spg_opts=spg_opts, tos_opts=tos_opts, years=years, limit=limit,
+                           sort_by=col, sort_dir=dir_sql.lower(), total=total, next_cursor=next_cursor, prev_cursor=prev_cursor,
+                           job_id=request.args.get('job_id', type=int), q=q,
+                           summary=dashboard_summary(month, year, crm, sp, spg, tos))
+
+@app.route('/admin/summary')
+@login_required(role='ADMIN')
+@etag_cached
+def admin_summary():
+    # Same filters (and default year) as the dashboard
+    month = request.args.get('month')
+    year = request.args.get('year') or datetime.today().strftime('%Y')
+    crm = request.args.get('crm_name')
+    sp = request.args.get('sale_person_name')
+    spg = request.args.get('spg_praneeth')
+    tos = request.args.get('type_of_sale')
+    return jsonify({"ok": True, "filters": {'year': year, 'month': month, 'crm_name': crm, 'sale_person_name': sp,
+                                             'spg_praneeth': spg, 'type_of_sale': tos},
+                    **dashboard_summary(month, year, crm, sp, spg, tos)})
+
+# Dashboard KPIs, read from sales_monthly_rollup (a few hundred rows) rather than
+# sale_details. Received includes payments; balance_amount is already kept net of
+# payments by the add-payment routes.
+SUMMARY_GROUPS = (('by_month', 'ym'), ('by_crm', 'crm_name'), ('by_sale_person', 'sale_person_name'))
+
+def rollup_filter_sql(month, year, crm, sp, spg, tos):
+    # admin_filter_sql's filters expressed on the rollup keys
+    clause, params = '', []
+    if year:
+        clause += " AND substr(ym, 1, 4) = ?"; params.append(year)
+    if month:
+        clause += " AND substr(ym, 6, 2) = ?"; params.append(month.zfill(2))
+    for col, value in (('crm_name', crm), ('sale_person_name', sp), ('spg_praneeth', spg), ('type_of_sale', tos)):
+        if value:
+            clause += f" AND {col} = ?"; params.append(value)
+    return clause, params
+
+def dashboard_summary(month, year, crm, sp, spg, tos):
+    # Totals plus the per-month/CRM/sales-person breakdowns in a single statement:
+    # the filtered rollup rows are read once (CTE) and grouped per dimension with UNION ALL
+    where_sql, params = rollup_filter_sql(month, year, crm, sp, spg, tos)
+    names = [m for m, _ in ROLLUP_MEASURES]
+    measures = ', '.join(f"COALESCE(SUM({m}), 0) AS {m}" for m in names)
+    parts = [f"SELECT 'totals' AS dim, NULL AS k, {measures} FROM f"]
+    parts += [f"SELECT '{dim}', {col}, {measures} FROM f GROUP BY {col}" for dim, col in SUMMARY_GROUPS]
+    sql = f"WITH f AS (SELECT * FROM sales_monthly_rollup WHERE 1=1{where_sql}) " + " UNION ALL ".join(parts)
+    cur = get_db().cursor()
+    cur.execute(sql, params)
+    summary = {'totals': dict.fromkeys(names, 0), **{dim: [] for dim, _ in SUMMARY_GROUPS}}
+    for row in cur.fetchall():
+        values = dict(zip(names, row[2:]))
+        if row[0] == 'totals':
+            summary['totals'] = values
+        else:
+            # '' is how the rollup stores a missing key
+            summary[row[0]].append({'key': row[1] or None, **values})
+    summary['by_month'].sort(key=lambda r: r['key'] or '', reverse=True)
+    for dim in ('by_crm', 'by_sale_person'):
+        summary[dim].sort(key=lambda r: r['total_sale_price'], reverse=True)
+    return summary
+
+def build_admin_filtered_rows(month, year, crm, sp, spg, tos):
+    # Generator over the filtered dashboard rows (export column order), read in chunks
+    where_sql, params = admin_filter_sql(month, year, crm, sp, spg, tos)
+    query = f"SELECT {SALE_EXPORT_COLUMNS} FROM sale_details WHERE 1=1{where_sql}"
+    for chunk in iter_query_chunks(query, params):
+        yield from chunk
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+# Workbooks larger than this spill from memory to a temporary file
+XLSX_SPOOL_BYTES = int(os.environ.get('XLSX_SPOOL_BYTES', str(8 * 1024 * 1024)))
+# number formats by index in SALE_EXPORT_COLUMNS
+XLSX_NUMBER_FORMATS = {0: '0', 4: '0', 10: '0', 11: '#,##0.00'}
+XLSX_NUMBER_FORMATS.update({idx: '"$ "#,##0.00' for idx in EXPORT_CURRENCY_IDX})
+XLSX_DATE_IDX = 1
+
+def xlsx_cell(ws, idx, value):
+    if value is None:
+        return None
+    if idx == XLSX_DATE_IDX:
+        try:
+            cell = WriteOnlyCell(ws, value=datetime.strptime(str(value)[:10], '%Y-%m-%d'))
+            cell.number_format = 'yyyy-mm-dd'
+            return cell
+        except ValueError:
+            return value
+    fmt = XLSX_NUMBER_FORMATS.get(idx)
+    if fmt is None:
+        return value
+    try:
+        num = float(re.sub(r"[^0-9.-]", "", value)) if isinstance(value, str) else float(value)
+    except ValueError:
+        return value
+    cell = WriteOnlyCell(ws, value=int(num) if fmt == '0' and num.is_integer() else num)
+    cell.number_format = fmt
+    return cell
+
+def generate_dashboard_xlsx(month, year, crm, sp, spg, tos, out=None):
+    # Rows stream from the cursor into a write-only workbook, so memory stays flat.
+    # Written to `out` if given, else to a spooled temp file that is returned.
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Dashboard')
+    for i, header in enumerate(EXPORT_HEADERS, start=1):
+        ws.column_dimensions[get_column_letter(i)].width = 40 if header == 'Notes' else min(max(len(header), 10) + 2, 28)
+    header_cells = []
+    for header in EXPORT_HEADERS:
+        cell = WriteOnlyCell(ws, value=header)
+        cell.font = Font(bold=True)
+        header_cells.append(cell)
+    ws.append(header_cells)
+    for r in build_admin_filtered_rows(month, year, crm, sp, spg, tos):
+        ws.append([xlsx_cell(ws, idx, v) for idx, v in enumerate(r)])
+    if out is not None:
+        wb.save(out)
+        return out
+    out = tempfile.SpooledTemporaryFile(max_size=XLSX_SPOOL_BYTES)
+    wb.save(out)
+    out.seek(0)
+    return out
+
+def dashboard_xlsx_file(filters):
+    # Open binary file of the dashboard workbook, generated once per filters + data version
+    if EXPORT_CACHE_MAX_BYTES <= 0:
+        return generate_dashboard_xlsx(*filters)
+    version = data_version()
+    path = export_cache_path('xlsx', filters, version)
+    f = open_cached_export(path)
+    if f:
+        return f
+    tmp = new_export_tempfile()
+    try:
+        generate_dashboard_xlsx(*filters, out=tmp)
+    except Exception:
+        tmp.close()
+        os.remove(tmp.name)
+        raise
+    tmp.close()
+    if publish_export(tmp.name, path, version):
+        return open(path, 'rb')
+    f = open(tmp.name, 'rb')
+    try:
+        os.remove(tmp.name)
+    except OSError:
+        pass  # still open on Windows; prune_export_cache sweeps it later
+    return f
+
+@app.route('/admin/export_xlsx')
+@login_required(role='ADMIN')
+@etag_cached
+def admin_export_xlsx():
+    month = request.args.get('month')
+    year = request.args.get('year')
+    crm = request.args.get('crm_name')
+    sp = request.args.get('sale_person_name')
+    spg = request.args.get('spg_praneeth')
+    tos = request.args.get('type_of_sale')
+    bio = dashboard_xlsx_file((month, year, crm, sp, spg, tos))
+    ts = datetime.today().strftime('%Y%m%d-%H%M%S')
+    return send_file(bio, mimetype=XLSX_MIMETYPE, as_attachment=True, download_name=f'admin_dashboard_{ts}.xlsx')
+
+# Background jobs: slow outbound work (WhatsApp delivery) runs on a small thread pool so
+# the admin's request returns at once. Each job is a row in `jobs`, which the dashboard
+# polls through /admin/jobs/<id>.
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '5'))
+JOB_BACKOFF_SECONDS = float(os.environ.get('JOB_BACKOFF_SECONDS', '2'))
+JOB_BACKOFF_MAX_SECONDS = 60.0
+# Point at a local stub server in development/tests
+WHATSAPP_GRAPH_URL = os.environ.get('WHATSAPP_GRAPH_URL', 'https://graph.facebook.com/v20.0').rstrip('/')
+
+_job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='jobs')
+
+# One keep-alive session for all Graph API calls, so repeated sends reuse TCP/TLS
+# connections instead of handshaking per request. Retries are done in graph_post.
+WHATSAPP_POOL_SIZE = int(os.environ.get('WHATSAPP_POOL_SIZE', '10'))
+graph_http = requests.Session()
+graph_http.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=WHATSAPP_POOL_SIZE, max_retries=0))
+graph_http.mount('http://', HTTPAdapter(pool_connections=2, pool_maxsize=WHATSAPP_POOL_SIZE, max_retries=0))
+
+# Uploaded media stays usable on WhatsApp for 30 days; reuse it a little less than that
+WHATSAPP_MEDIA_TTL_SECONDS = float(os.environ.get('WHATSAPP_MEDIA_TTL_DAYS', '29')) * 86400
+_media_cache = {}
+# key -> [lock, jobs holding or waiting for it]; removed when the last one is done
+_media_upload_locks = {}
+_media_lock = threading.Lock()
+
+def ensure_jobs_table():
     conn = engine.raw_connection()
     try:
         cur = conn.cursor()
-        # Options for dropdowns
-        cur.execute("SELECT DISTINCT crm_name FROM sale_details WHERE crm_name IS NOT NULL ORDER BY crm_name")
-        crm_opts = [r[0] for r in cur.fetchall()]
-        cur.execute("SELECT DISTINCT sale_person_name FROM sale_details WHERE sale_person_name IS NOT NULL ORDER BY sale_person_name")
-        sp_opts = [r[0] for r in cur.fetchall()]
-        cur.execute("SELECT value FROM spg_options ORDER BY value")
-        spg_opts = [r[0] for r in cur.fetchall()]
-        cur.execute("SELECT value FROM sale_type_options ORDER BY value")
-        tos_opts = [r[0] for r in cur.fetchall()]
-
-        # Detailed rows with all required columns for dashboard order
-        query = (
-            "SELECT rowid, "
-            "s_no, booking_date, project, spg_praneeth, token, buyer_name, sale_person_name, crm_name, sol, "
-            "type_of_sale, land_sqyards, sbua_sqft, facing, base_sqft_price, amenties_and_premiums, "
-            "total_sale_price, amount_received, balance_amount, balance_tobe_received_by_plan_approval, notes, "
-            "balance_tobe_received_during_exec "
-            "FROM sale_details WHERE 1=1"
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued' CHECK(status IN ('queued','running','done','failed')),
+                params TEXT,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_by TEXT,
+                created_at TEXT,
+                updated_at TEXT
+            )
+            """
         )
-        params = []
-        if year:
-            query += " AND strftime('%Y', booking_date) = ?"; params.append(year)
-        if month:
-            query += " AND strftime('%m', booking_date) = ?"; params.append(month.zfill(2))
-        if crm:
-            query += " AND crm_name = ?"; params.append(crm)
-        if sp:
-            query += " AND sale_person_name = ?"; params.append(sp)
-        if spg:
-            query += " AND spg_praneeth = ?"; params.append(spg)
-        if tos:
-            query += " AND type_of_sale = ?"; params.append(tos)
-        # Sorting
-        sort_by = request.args.get('sort_by','booking_date')
-        sort_dir = request.args.get('sort_dir','desc').lower()
-        allowed = {
-            's_no':'s_no','booking_date':'booking_date','project':'project','spg_praneeth':'spg_praneeth','token':'token',
-            'buyer_name':'buyer_name','sale_person_name':'sale_person_name','crm_name':'crm_name','sol':'sol','type_of_sale':'type_of_sale',
-            'land_sqyards':'land_sqyards','sbua_sqft':'sbua_sqft','facing':'facing','base_sqft_price':'base_sqft_price',
-            'amenties_and_premiums':'amenties_and_premiums','total_sale_price':'total_sale_price','amount_received':'amount_received',
-            'balance_amount':'balance_amount','balance_tobe_received_by_plan_approval':'balance_tobe_received_by_plan_approval',
-            'notes':'notes','balance_tobe_received_during_exec':'balance_tobe_received_during_exec'
-        }
-        col = allowed.get(sort_by, 'booking_date')
-        dir_sql = 'DESC' if sort_dir == 'desc' else 'ASC'
-        if col == 'booking_date' and dir_sql == 'DESC':
-            query += " ORDER BY (booking_date IS NULL) ASC, booking_date DESC, s_no DESC"
-        else:
-            query += f" ORDER BY {col} {dir_sql}"
-        # limit rows: default 10, allow 25 or 50
-        try:
-            limit = int(request.args.get('limit') or 10)
-        except:
-            limit = 10
-        if limit not in (10,25,50):
-            limit = 10
-        query += " LIMIT ?"
-        params.append(limit)
-        cur.execute(query, tuple(params))
-        rows = cur.fetchall()
-        cols = [d[0] for d in cur.description]
-        data = []
-        for r in rows:
-            rec = dict(zip(cols, r))
-            # Compute effective amount received = initial amount + sum(payments)
-            try:
-                rid = rec.get('rowid')
-                cur.execute("SELECT COALESCE(SUM(amount),0) FROM payments WHERE sale_rowid = ?", (rid,))
-                pay_sum = cur.fetchone()[0] or 0
-            except Exception:
-                pay_sum = 0
-            try:
-                base_received = float(rec.get('amount_received') or 0)
-            except Exception:
-                base_received = 0.0
-            rec['amount_received_effective'] = base_received + (pay_sum or 0)
-            data.append(rec)
-        # Year options: current, current-1, current-2
-        cur_year = int(datetime.today().strftime('%Y'))
-        years = [str(cur_year - i) for i in range(0,3)]
-        return render_template('admin_dashboard.html', data=data, filters={'year':year,'month':month,'crm':crm,'sp':sp,'spg':spg,'tos':tos},
-                               crm_opts=crm_opts, sp_opts=sp_opts, spg_opts=spg_opts, tos_opts=tos_opts, years=years, limit=limit,
-                               sort_by=col, sort_dir=dir_sql.lower())
+        # Media IDs of uploaded reports, keyed by report content (see report_media_key)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS whatsapp_media (
+                content_key TEXT PRIMARY KEY,
+                media_id TEXT NOT NULL,
+                filename TEXT,
+                uploaded_at REAL NOT NULL
+            )
+            """
+        )
+        conn.commit()
     finally:
         conn.close()
 
-def build_admin_filtered_rows(month, year, crm, sp, spg, tos):
+ensure_jobs_table()
+
+def fail_orphaned_jobs():
+    # Jobs run on this process's thread pool, so a queued or running job left by a
+    # restart or crash will never finish; fail it rather than re-run it, since a
+    # half-done broadcast would message people twice
     conn = engine.raw_connection()
     try:
         cur = conn.cursor()
-        query = (
-            "SELECT "
-            "s_no, booking_date, project, spg_praneeth, token, buyer_name, sale_person_name, crm_name, sol, "
-            "type_of_sale, land_sqyards, sbua_sqft, facing, base_sqft_price, amenties_and_premiums, "
-            "total_sale_price, amount_received, balance_amount, balance_tobe_received_by_plan_approval, notes, "
-            "balance_tobe_received_during_exec "
-            "FROM sale_details WHERE 1=1"
+        cur.execute(
+            "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE status IN ('queued', 'running')",
+            ('interrupted: the app restarted before the job finished', datetime.now().strftime('%Y-%m-%dT%H:%M:%S'))
         )
-        params = []
-        if year:
-            query += " AND strftime('%Y', booking_date) = ?"; params.append(year)
-        if month:
-            query += " AND strftime('%m', booking_date) = ?"; params.append(month.zfill(2))
-        if crm:
-            query += " AND crm_name = ?"; params.append(crm)
-        if sp:
-            query += " AND sale_person_name = ?"; params.append(sp)
-        if spg:
-            query += " AND spg_praneeth = ?"; params.append(spg)
-        if tos:
-            query += " AND type_of_sale = ?"; params.append(tos)
-        cur.execute(query, tuple(params))
-        rows = cur.fetchall()
-        return rows
+        if cur.rowcount:
+            print(f"Marked {cur.rowcount} unfinished job(s) from a previous run as failed")
+        conn.commit()
     finally:
         conn.close()
 
-def generate_dashboard_xlsx(month, year, crm, sp, spg, tos):
-    import pandas as pd
-    rows = build_admin_filtered_rows(month, year, crm, sp, spg, tos)
-    headers = [
-        'S.No','Booking Date','Project','SPG/Praneeth','Token','Buyer Name','Sale Person Name','CRM Name','SOL',
-        'Type of Sale','Land (sq yards)','SBUA (sq feet)','Facing','Base sq ft price','Amenities and Premiums',
-        'Total Sale Price','Amount Received','Balance Amount','Balance to be received by plan approval','Notes',
-        'Balance to be received during execution'
-    ]
-    df = pd.DataFrame(list(rows), columns=headers)
-    bio = BytesIO()
-    with pd.ExcelWriter(bio, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Dashboard')
-    bio.seek(0)
-    return bio
+fail_orphaned_jobs()
+
+def update_job(job_id, **fields):
+    fields['updated_at'] = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+        (*fields.values(), job_id)
+    )
+    conn.commit()
+
+def enqueue_job(kind, params, username):
+    now = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO jobs(kind, status, params, created_by, created_at, updated_at) VALUES (?, 'queued', ?, ?, ?, ?)",
+        (kind, json.dumps(params), username, now, now)
+    )
+    job_id = cur.lastrowid
+    conn.commit()
+    _job_executor.submit(run_job, job_id)
+    return job_id
+
+def run_job(job_id):
+    # Worker thread: gets its own app context (and so its own get_db() connection)
+    with app.app_context():
+        cur = get_db().cursor()
+        cur.execute("SELECT kind, params FROM jobs WHERE id = ?", (job_id,))
+        row = cur.fetchone()
+        if not row:
+            return
+        kind, params = row[0], json.loads(row[1] or '{}')
+        update_job(job_id, status='running')
+        try:
+            result = JOB_HANDLERS[kind](job_id, params)
+            update_job(job_id, status='done', result=json.dumps(result), error=None)
+        except Exception as e:
+            update_job(job_id, status='failed', error=str(e)[:1000])
+
+def retry_delay(res, attempt):
+    # Honour Retry-After (seconds) when the server sends one, else exponential backoff
+    if res is not None:
+        try:
+            return min(float(res.headers.get('Retry-After')), JOB_BACKOFF_MAX_SECONDS)
+        except (TypeError, ValueError):
+            pass
+    return min(JOB_BACKOFF_SECONDS * (2 ** attempt), JOB_BACKOFF_MAX_SECONDS)
+
+def graph_post(job_id, url, **kwargs):
+    # POST with retries on connection errors, 429 and 5xx; returns the last response,
+    # or raises the last connection error
+    files = kwargs.get('files') or {}
+    for attempt in range(JOB_MAX_ATTEMPTS):
+        for f in files.values():
+            f[1].seek(0)  # rewind the upload between attempts
+        res, err = None, None
+        try:
+            res = graph_http.post(url, timeout=30, **kwargs)
+            if res.status_code != 429 and res.status_code < 500:
+                return res
+            err = f"HTTP {res.status_code}"
+        except (requests.ConnectionError, requests.Timeout) as e:
+            err = str(e)
+        if job_id is not None:
+            # jobs.attempts counts retried calls across the whole job
+            conn = get_db()
+            conn.cursor().execute(
+                "UPDATE jobs SET attempts = attempts + 1, error = ?, updated_at = ? WHERE id = ?",
+                (f"retry {attempt + 1}: {err[:300]}", datetime.now().strftime('%Y-%m-%dT%H:%M:%S'), job_id)
+            )
+            conn.commit()
+        if attempt + 1 < JOB_MAX_ATTEMPTS:
+            time.sleep(retry_delay(res, attempt))
+    if res is not None:
+        return res
+    raise RuntimeError(f"WhatsApp API unreachable after {JOB_MAX_ATTEMPTS} attempts: {err[:300]}")
+
+def whatsapp_message_id(body):
+    msgs = (body or {}).get('messages') or []
+    if msgs and isinstance(msgs, list):
+        return (msgs[0] or {}).get('id')
+    return None
+
+def report_media_key(phone_id, filters):
+    # Hash of the rows the report would contain (plus the sending number's id, which owns
+    # the media). The XLSX bytes themselves differ per build (timestamps), so they can't
+    # be the key.
+    digest = hashlib.sha256(f"{phone_id}\n".encode('utf-8'))
+    for r in build_admin_filtered_rows(*filters):
+        digest.update(repr(tuple(r)).encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+def cached_media(key):
+    now = time.time()
+    with _media_lock:
+        hit = _media_cache.get(key)
+    if hit is None:
+        cur = get_db().cursor()
+        cur.execute("SELECT media_id, filename, uploaded_at FROM whatsapp_media WHERE content_key = ?", (key,))
+        hit = cur.fetchone()
+    if hit and now - hit[2] < WHATSAPP_MEDIA_TTL_SECONDS:
+        store_cached_media(key, hit)
+        return hit
+    return None
+
+def store_cached_media(key, entry):
+    # Keys follow the report's rows, so every data change adds new ones; drop the
+    # expired entries as new ones arrive
+    with _media_lock:
+        for k in [k for k, v in _media_cache.items() if entry[2] - v[2] >= WHATSAPP_MEDIA_TTL_SECONDS]:
+            del _media_cache[k]
+        _media_cache[key] = entry
+
+def remember_media(key, media_id, filename):
+    entry = (media_id, filename, time.time())
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM whatsapp_media WHERE uploaded_at < ?", (entry[2] - WHATSAPP_MEDIA_TTL_SECONDS,))
+    cur.execute(
+        "INSERT INTO whatsapp_media(content_key, media_id, filename, uploaded_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(content_key) DO UPDATE SET media_id = excluded.media_id, filename = excluded.filename, uploaded_at = excluded.uploaded_at",
+        (key, *entry)
+    )
+    conn.commit()
+    store_cached_media(key, entry)
+
+def forget_media(key):
+    conn = get_db()
+    conn.cursor().execute("DELETE FROM whatsapp_media WHERE content_key = ?", (key,))
+    conn.commit()
+    with _media_lock:
+        _media_cache.pop(key, None)
+
+def upload_dashboard_media(job_id, token, phone_id, filters, key):
+    ts = datetime.today().strftime('%Y%m%d-%H%M%S')
+    filename = f'dashboard_{ts}.xlsx'
+    headers = { 'Authorization': f'Bearer {token}' }
+    data = { 'messaging_product': 'whatsapp', 'type': XLSX_MIMETYPE }
+    with dashboard_xlsx_file(filters) as bio:
+        files = { 'file': (filename, bio, XLSX_MIMETYPE) }
+        up_res = graph_post(job_id, f'{WHATSAPP_GRAPH_URL}/{phone_id}/media', headers=headers, data=data, files=files)
+    if not up_res.ok:
+        raise RuntimeError(f"Failed to upload media to WhatsApp (HTTP {up_res.status_code}). {up_res.text[:300]}")
+    media_id = (up_res.json() or {}).get('id')
+    if not media_id:
+        raise RuntimeError('Invalid media upload response.')
+    remember_media(key, media_id, filename)
+    return media_id, filename
+
+def dashboard_media(job_id, token, phone_id, filters, key):
+    # (media_id, filename, from_cache): an identical report is uploaded once and reused.
+    # Jobs sending the same report wait for the first upload instead of repeating it.
+    with _media_lock:
+        entry = _media_upload_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            hit = cached_media(key)
+            if hit:
+                return hit[0], hit[1], True
+            media_id, filename = upload_dashboard_media(job_id, token, phone_id, filters, key)
+            return media_id, filename, False
+    finally:
+        with _media_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _media_upload_locks[key]
+
+def whatsapp_credentials():
+    token = os.environ.get('WHATSAPP_TOKEN')
+    phone_id = os.environ.get('WHATSAPP_PHONE_NUMBER_ID')
+    if not token or not phone_id:
+        raise RuntimeError('WhatsApp credentials missing. Set WHATSAPP_TOKEN and WHATSAPP_PHONE_NUMBER_ID.')
+    return token, phone_id
+
+def job_filters(params):
+    return (params.get('month'), params.get('year'), params.get('crm'), params.get('sp'), params.get('spg'), params.get('tos'))
+
+def post_document(job_id, token, phone_id, to_number, media_id, filename):
+    # Callers take a token from _send_bucket first
+    payload = {
+        'messaging_product': 'whatsapp',
+        'to': to_number,
+        'type': 'document',
+        'document': { 'id': media_id, 'filename': filename }
+    }
+    headers = { 'Authorization': f'Bearer {token}', 'Content-Type': 'application/json' }
+    return graph_post(job_id, f'{WHATSAPP_GRAPH_URL}/{phone_id}/messages', headers=headers, json=payload)
+
+def timed_post_document(*args):
+    # (response, ms) for the API call itself, not the wait for a send token
+    _send_bucket.acquire()
+    started = time.perf_counter()
+    res = post_document(*args)
+    return res, round((time.perf_counter() - started) * 1000, 1)
+
+def send_report_document(job_id, token, phone_id, filters, key, to_number):
+    # Sends the (cached or freshly uploaded) report; returns (response, media_id, filename,
+    # from_cache, latency_ms), the latency being that of the final send only
+    media_id, filename, from_cache = dashboard_media(job_id, token, phone_id, filters, key)
+    msg_res, latency_ms = timed_post_document(job_id, token, phone_id, to_number, media_id, filename)
+    if not msg_res.ok and from_cache and msg_res.status_code < 500:
+        # A cached media id the platform rejects (expired or deleted early): upload afresh once
+        forget_media(key)
+        media_id, filename, from_cache = dashboard_media(job_id, token, phone_id, filters, key)
+        msg_res, latency_ms = timed_post_document(job_id, token, phone_id, to_number, media_id, filename)
+    return msg_res, media_id, filename, from_cache, latency_ms
+
+def response_json(res):
+    try:
+        return res.json() or {}
+    except Exception:
+        return {}
+
+def send_dashboard_whatsapp_job(job_id, params):
+    token, phone_id = whatsapp_credentials()
+    filters = job_filters(params)
+    key = report_media_key(phone_id, filters)
+    msg_res, _, filename, from_cache, _ = send_report_document(job_id, token, phone_id, filters, key, params['to_number'])
+    if not msg_res.ok:
+        raise RuntimeError(f"Failed to send WhatsApp message (HTTP {msg_res.status_code}). {msg_res.text[:300]}")
+    return {'message_id': whatsapp_message_id(response_json(msg_res)), 'filename': filename, 'to': params['to_number'], 'media_cached': from_cache}
+
+# Broadcast: one workbook, one upload, then the document message to every recipient in
+# parallel, paced by a process-wide token bucket (the API caps messages per second per
+# sending number)
+WHATSAPP_SEND_RATE = float(os.environ.get('WHATSAPP_SEND_RATE', '20'))
+WHATSAPP_SEND_BURST = int(os.environ.get('WHATSAPP_SEND_BURST', '20'))
+WHATSAPP_BROADCAST_WORKERS = int(os.environ.get('WHATSAPP_BROADCAST_WORKERS', '8'))
+# upper bounds (ms) of the latency histogram buckets in broadcast results
+LATENCY_BUCKETS_MS = (100, 250, 500, 1000, 2500, 5000, 10000)
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Blocks until a token is available
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+_send_bucket = TokenBucket(WHATSAPP_SEND_RATE, WHATSAPP_SEND_BURST)
+
+def latency_summary(latencies_ms, bucket_bounds=LATENCY_BUCKETS_MS):
+    if not latencies_ms:
+        return {}
+    ordered = sorted(latencies_ms)
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))], 1)
+    buckets = {f'le_{b}': 0 for b in bucket_bounds}
+    buckets['le_inf'] = 0
+    for ms in ordered:
+        label = next((f'le_{b}' for b in bucket_bounds if ms <= b), 'le_inf')
+        buckets[label] += 1
+    return {'count': len(ordered), 'p50': pct(50), 'p95': pct(95), 'p99': pct(99), 'max': round(ordered[-1], 1), 'buckets': buckets}
+
+def broadcast_result(filename, from_cache, recipients, results):
+    sent = sum(1 for r in results if r['ok'])
+    return {
+        'filename': filename, 'media_cached': from_cache,
+        'total': len(recipients), 'sent': sent, 'failed': len(results) - sent,
+        'recipients': results,
+        'latency_ms': latency_summary([r['latency_ms'] for r in results]),
+    }
+
+def send_to_recipient(job_id, token, phone_id, to_number, media_id, filename):
+    _send_bucket.acquire()
+    # latency of the API call itself, not the wait for a token
+    started = time.perf_counter()
+    try:
+        res = post_document(job_id, token, phone_id, to_number, media_id, filename)
+        ok, status = res.ok, res.status_code
+        message_id = whatsapp_message_id(response_json(res)) if ok else None
+        error = None if ok else res.text[:300]
+    except Exception as e:
+        ok, status, message_id, error = False, None, None, str(e)[:300]
+    return {'to': to_number, 'ok': ok, 'status': status, 'message_id': message_id, 'error': error,
+            'latency_ms': round((time.perf_counter() - started) * 1000, 1)}
+
+def send_to_recipient_in_context(*args):
+    # graph_post records retries on the job row, which needs an app context per thread
+    with app.app_context():
+        return send_to_recipient(*args)
+
+def broadcast_dashboard_whatsapp_job(job_id, params):
+    token, phone_id = whatsapp_credentials()
+    filters = job_filters(params)
+    recipients = params['to_numbers']
+    key = report_media_key(phone_id, filters)
+    # The first send also proves the (possibly cached) media id is still accepted
+    msg_res, media_id, filename, from_cache, latency_ms = send_report_document(job_id, token, phone_id, filters, key, recipients[0])
+    results = [{
+        'to': recipients[0], 'ok': msg_res.ok, 'status': msg_res.status_code,
+        'message_id': whatsapp_message_id(response_json(msg_res)) if msg_res.ok else None,
+        'error': None if msg_res.ok else msg_res.text[:300],
+        'latency_ms': latency_ms,
+    }]
+    with ThreadPoolExecutor(max_workers=WHATSAPP_BROADCAST_WORKERS, thread_name_prefix='broadcast') as pool:
+        futures = [pool.submit(send_to_recipient_in_context, job_id, token, phone_id, n, media_id, filename)
+                   for n in recipients[1:]]
+        for done_count, future in enumerate(as_completed(futures), 1):
+            results.append(future.result())
+            if done_count % 10 == 0:
+                update_job(job_id, result=json.dumps(broadcast_result(filename, from_cache, recipients, results)))
+    results.sort(key=lambda r: recipients.index(r['to']))
+    result = broadcast_result(filename, from_cache, recipients, results)
+    if not result['sent']:
+        raise RuntimeError(f"Broadcast failed for all {len(recipients)} recipients. {results[0]['error'] or ''}"[:1000])
+    return result
+
+def recompute_derived_job(job_id, params):
+    # One transaction for the whole table: either every drifted row is fixed or none is
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        report = recompute_derived(cur, apply=bool(params.get('apply')))
+        if report['applied']:
+            conn.commit()
+        else:
+            conn.rollback()
+    except Exception:
+        conn.rollback()
+        raise
+    return report
+
+JOB_HANDLERS = {
+    'whatsapp_dashboard': send_dashboard_whatsapp_job,
+    'whatsapp_broadcast': broadcast_dashboard_whatsapp_job,
+    'recompute_derived': recompute_derived_job,
+}
+
+@app.route('/admin/jobs/<int:job_id>')
+@login_required(role='ADMIN')
+def admin_job_status(job_id):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT id, kind, status, attempts, result, error, created_by, created_at, updated_at FROM jobs WHERE id = ?", (job_id,))
+    row = cur.fetchone()
+    if not row:
+        return jsonify({"ok": False, "error": "job not found"}), 404
+    job = dict(zip([d[0] for d in cur.description], row))
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return jsonify({"ok": True, "job": job})
+
+def metrics_snapshot():
+    with _route_metrics_lock:
+        return {k: dict(m, buckets=list(m['buckets']), recent=list(m['recent'])) for k, m in _route_metrics.items()}
+
+def metrics_json(snapshot):
+    endpoints = {}
+    for endpoint, m in sorted(snapshot.items()):
+        endpoints[endpoint] = {
+            'requests': m['requests'],
+            'errors': m['errors'],
+            # percentiles over the last REQUEST_METRICS_WINDOW requests
+            'latency_ms': latency_summary(m['recent'], REQUEST_LATENCY_BUCKETS_MS),
+            'sql': {
+                'statements': m['statements'],
+                'statements_per_request': round(m['statements'] / m['requests'], 2),
+                'max_statements': m['max_statements'],
+                'rows_fetched': m['rows'],
+                'seconds': round(m['sql_seconds'], 4),
+                'over_budget': m['over_budget'],
+            },
+        }
+    return {'query_budget': QUERY_BUDGET, 'window': REQUEST_METRICS_WINDOW, 'endpoints': endpoints}
+
+def metrics_prometheus(snapshot):
+    lines = []
+    def family(name, kind, help_text):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+    items = sorted(snapshot.items())
+    family('arcadia_http_request_duration_seconds', 'histogram', 'Request latency by endpoint.')
+    for endpoint, m in items:
+        cumulative = 0
+        for bound, count in zip(REQUEST_LATENCY_BUCKETS_MS + ('+Inf',), m['buckets']):
+            cumulative += count
+            le = bound if bound == '+Inf' else f'{bound / 1000:g}'
+            lines.append(f'arcadia_http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{le}"}} {cumulative}')
+        lines.append(f'arcadia_http_request_duration_seconds_sum{{endpoint="{endpoint}"}} {m["seconds"]:.6f}')
+        lines.append(f'arcadia_http_request_duration_seconds_count{{endpoint="{endpoint}"}} {m["requests"]}')
+    family('arcadia_http_request_duration_quantile_seconds', 'gauge', 'Latency percentiles over recent requests.')
+    for endpoint, m in items:
+        summary = latency_summary(m['recent'], REQUEST_LATENCY_BUCKETS_MS)
+        for quantile, key in (('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99')):
+            if summary:
+                lines.append(f'arcadia_http_request_duration_quantile_seconds{{endpoint="{endpoint}",quantile="{quantile}"}} {summary[key] / 1000:.6f}')
+    counters = [
+        ('arcadia_http_request_errors_total', 'errors', 'Requests that failed with a 5xx or an exception.'),
+        ('arcadia_sql_statements_total', 'statements', 'SQL statements executed while serving requests.'),
+        ('arcadia_sql_rows_fetched_total', 'rows', 'Rows fetched from SQLite while serving requests.'),
+        ('arcadia_sql_seconds_total', 'sql_seconds', 'Time spent executing SQL statements.'),
+        ('arcadia_query_budget_exceeded_total', 'over_budget', 'Requests that ran more than QUERY_BUDGET statements.'),
+    ]
+    for name, key, help_text in counters:
+        family(name, 'counter', help_text)
+        for endpoint, m in items:
+            lines.append(f'{name}{{endpoint="{endpoint}"}} {m[key]}')
+    family('arcadia_sql_statements_max', 'gauge', 'Most SQL statements run by a single request.')
+    for endpoint, m in items:
+        lines.append(f'arcadia_sql_statements_max{{endpoint="{endpoint}"}} {m["max_statements"]}')
+    return '\n'.join(lines) + '\n'
+
+def metrics_response():
+    snapshot = metrics_snapshot()
+    if request.args.get('format') == 'prometheus':
+        return Response(metrics_prometheus(snapshot), mimetype='text/plain; version=0.0.4')
+    return jsonify(metrics_json(snapshot))
+
+_admin_metrics = login_required(role='ADMIN')(metrics_response)
+
+@app.route('/admin/metrics')
+def admin_metrics():
+    # Admins use their session; a scraper can send "Authorization: Bearer $METRICS_TOKEN"
+    auth = request.headers.get('Authorization', '')
+    if METRICS_TOKEN and hmac.compare_digest(auth.encode(), f'Bearer {METRICS_TOKEN}'.encode()):
+        return metrics_response()
+    return _admin_metrics()
 
-@app.route('/admin/export_xlsx')
+@app.route('/admin/recompute', methods=['POST'])
 @login_required(role='ADMIN')
-def admin_export_xlsx():
-    month = request.args.get('month')
-    year = request.args.get('year')
-    crm = request.args.get('crm_name')
-    sp = request.args.get('sale_person_name')
-    spg = request.args.get('spg_praneeth')
-    tos = request.args.get('type_of_sale')
-    bio = generate_dashboard_xlsx(month, year, crm, sp, spg, tos)
-    ts = datetime.today().strftime('%Y%m%d-%H%M%S')
-    return send_file(bio, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', as_attachment=True, download_name=f'admin_dashboard_{ts}.xlsx')
+def admin_recompute():
+    # Dry run unless apply=1; the report is the job's result
+    apply = request.form.get('apply') == '1'
+    job_id = enqueue_job('recompute_derived', {'apply': apply}, current_user().username)
+    flash('Recompute of derived columns started' if apply else 'Drift check started', 'success')
+    return redirect(url_for('admin_dashboard', job_id=job_id))
 
 @app.route('/admin/send_whatsapp', methods=['POST'])
 @login_required(role='ADMIN')
 def admin_send_whatsapp():
     to_number_raw = (request.form.get('to_number') or '').strip()
-    # Sanitize to E.164 numeric string without spaces or dashes; remove leading '+' for API
-    to_number = re.sub(r"[^0-9]", "", to_number_raw)
+    # One or more numbers separated by commas, semicolons or new lines. Sanitize each to
+    # an E.164 numeric string without spaces or dashes; remove leading '+' for API
+    to_numbers = []
+    for part in re.split(r"[,;\n]+", to_number_raw):
+        n = re.sub(r"[^0-9]", "", part)
+        if n and n not in to_numbers:
+            to_numbers.append(n)
+    to_number = to_numbers[0] if to_numbers else ''
     month = request.form.get('month')
     year = request.form.get('year')
     crm = request.form.get('crm_name')
@@ -707,63 +2361,15 @@ def admin_send_whatsapp():
     if not token or not phone_id:
         flash('WhatsApp credentials missing. Set WHATSAPP_TOKEN and WHATSAPP_PHONE_NUMBER_ID.', 'error')
         return redirect(url_for('admin_dashboard', year=year, month=month, crm_name=crm, sale_person_name=sp, spg_praneeth=spg, type_of_sale=tos))
-    bio = generate_dashboard_xlsx(month, year, crm, sp, spg, tos)
-    ts = datetime.today().strftime('%Y%m%d-%H%M%S')
-    filename = f'dashboard_{ts}.xlsx'
-    try:
-        upload_url = f'https://graph.facebook.com/v20.0/{phone_id}/media'
-        headers = { 'Authorization': f'Bearer {token}' }
-        files = { 'file': (filename, bio, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet') }
-        data = { 'messaging_product': 'whatsapp', 'type': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet' }
-        up_res = requests.post(upload_url, headers=headers, data=data, files=files, timeout=30)
-        if not up_res.ok:
-            try:
-                err_txt = up_res.text
-            except Exception:
-                err_txt = ''
-            flash(f"Failed to upload media to WhatsApp (HTTP {up_res.status_code}). {err_txt[:300]}", 'error')
-            return redirect(url_for('admin_dashboard', year=year, month=month, crm_name=crm, sale_person_name=sp, spg_praneeth=spg, type_of_sale=tos))
-        media_id = (up_res.json() or {}).get('id')
-        if not media_id:
-            flash('Invalid media upload response.', 'error')
-            return redirect(url_for('admin_dashboard', year=year, month=month, crm_name=crm, sale_person_name=sp, spg_praneeth=spg, type_of_sale=tos))
-        msg_url = f'https://graph.facebook.com/v20.0/{phone_id}/messages'
-        payload = {
-            'messaging_product': 'whatsapp',
-            'to': to_number,
-            'type': 'document',
-            'document': { 'id': media_id, 'filename': filename }
-        }
-        msg_res = requests.post(msg_url, headers={**headers, 'Content-Type': 'application/json'}, json=payload, timeout=30)
-        try:
-            try:
-                body = msg_res.json() or {}
-            except Exception:
-                body = {}
-            if not msg_res.ok:
-                try:
-                    err_txt = msg_res.text
-                except Exception:
-                    err_txt = ''
-                flash(f"Failed to send WhatsApp message (HTTP {msg_res.status_code}). {err_txt[:300]}", 'error')
-                return redirect(url_for('admin_dashboard', year=year, month=month, crm_name=crm, sale_person_name=sp, spg_praneeth=spg, type_of_sale=tos))
-            mid = None
-            try:
-                msgs = body.get('messages') or []
-                if msgs and isinstance(msgs, list):
-                    mid = (msgs[0] or {}).get('id')
-            except Exception:
-                mid = None
-            if mid:
-                flash(f'Dashboard Excel sent via WhatsApp. id={mid}', 'success')
-            else:
-                frag = str(body)[:300]
-                flash(f'Dashboard Excel sent via WhatsApp. Response: {frag}', 'success')
-        except Exception:
-            flash('Error sending WhatsApp message.', 'error')
-    except Exception:
-        flash('Error sending WhatsApp message.', 'error')
-    return redirect(url_for('admin_dashboard', year=year, month=month, crm_name=crm, sale_person_name=sp, spg_praneeth=spg, type_of_sale=tos))
+    # Building the workbook and the Graph API calls happen on the job pool
+    params = {'month': month, 'year': year, 'crm': crm, 'sp': sp, 'spg': spg, 'tos': tos}
+    if len(to_numbers) > 1:
+        job_id = enqueue_job('whatsapp_broadcast', {**params, 'to_numbers': to_numbers}, current_user().username)
+        flash(f'WhatsApp broadcast to {len(to_numbers)} recipients queued (job #{job_id}).', 'success')
+    else:
+        job_id = enqueue_job('whatsapp_dashboard', {**params, 'to_number': to_number}, current_user().username)
+        flash(f'WhatsApp delivery queued (job #{job_id}).', 'success')
+    return redirect(url_for('admin_dashboard', year=year, month=month, crm_name=crm, sale_person_name=sp, spg_praneeth=spg, type_of_sale=tos, job_id=job_id))
 
 # Debug route: send a plain text WhatsApp message to verify credentials and recipient status
 @app.route('/admin/send_whatsapp_text', methods=['POST'])
@@ -787,7 +2393,7 @@ def admin_send_whatsapp_text():
         flash('WhatsApp credentials missing. Set WHATSAPP_TOKEN and WHATSAPP_PHONE_NUMBER_ID.', 'error')
         return redirect(url_for('admin_dashboard', year=year, month=month, crm_name=crm, sale_person_name=sp, spg_praneeth=spg, type_of_sale=tos))
     try:
-        msg_url = f'https://graph.facebook.com/v20.0/{phone_id}/messages'
+        msg_url = f'{WHATSAPP_GRAPH_URL}/{phone_id}/messages'
         headers = { 'Authorization': f'Bearer {token}', 'Content-Type': 'application/json' }
         lower_msg = (message or '').strip().lower()
         if lower_msg.startswith('template:'):
@@ -810,7 +2416,7 @@ def admin_send_whatsapp_text():
                     'type': 'template',
                     'template': {'name': tname, 'language': {'code': tlang}}
                 }
-                tpl_res = requests.post(msg_url, headers=headers, json=tpl, timeout=30)
+                tpl_res = graph_http.post(msg_url, headers=headers, json=tpl, timeout=30)
                 try:
                     try:
                         t_body = tpl_res.json() or {}
@@ -847,7 +2453,7 @@ def admin_send_whatsapp_text():
             'type': 'text',
             'text': { 'body': message }
         }
-        res = requests.post(msg_url, headers=headers, json=payload, timeout=30)
+        res = graph_http.post(msg_url, headers=headers, json=payload, timeout=30)
         try:
             try:
                 body = res.json() or {}
@@ -873,7 +2479,7 @@ def admin_send_whatsapp_text():
                         'type': 'template',
                         'template': {'name': 'hello_world', 'language': {'code': 'en_US'}}
                     }
-                    tpl_res = requests.post(msg_url, headers=headers, json=tpl, timeout=30)
+                    tpl_res = graph_http.post(msg_url, headers=headers, json=tpl, timeout=30)
                     if tpl_res.ok:
                         try:
                             t_body = tpl_res.json() or {}
@@ -912,64 +2518,22 @@ def admin_send_whatsapp_text():
 
 @app.route('/admin/export')
 @login_required(role='ADMIN')
+@etag_cached
 def admin_export():
-    # Export current filtered dashboard data as CSV
+    # Export current filtered dashboard data as CSV (or JSON Lines with format=jsonl)
     month = request.args.get('month')
     year = request.args.get('year')
     crm = request.args.get('crm_name')
     sp = request.args.get('sale_person_name')
     spg = request.args.get('spg_praneeth')
     tos = request.args.get('type_of_sale')
-    conn = engine.raw_connection()
-    try:
-        cur = conn.cursor()
-        # Use same column set and order as the dashboard table
-        query = (
-            "SELECT "
-            "s_no, booking_date, project, spg_praneeth, token, buyer_name, sale_person_name, crm_name, sol, "
-            "type_of_sale, land_sqyards, sbua_sqft, facing, base_sqft_price, amenties_and_premiums, "
-            "total_sale_price, amount_received, balance_amount, balance_tobe_received_by_plan_approval, notes, "
-            "balance_tobe_received_during_exec "
-            "FROM sale_details WHERE 1=1"
-        )
-        params = []
-        if year:
-            query += " AND strftime('%Y', booking_date) = ?"; params.append(year)
-        if month:
-            query += " AND strftime('%m', booking_date) = ?"; params.append(month.zfill(2))
-        if crm:
-            query += " AND crm_name = ?"; params.append(crm)
-        if sp:
-            query += " AND sale_person_name = ?"; params.append(sp)
-        if spg:
-            query += " AND spg_praneeth = ?"; params.append(spg)
-        if tos:
-            query += " AND type_of_sale = ?"; params.append(tos)
-        cur.execute(query, tuple(params))
-        rows = cur.fetchall()
-        text = StringIO()
-        writer = csv.writer(text)
-        writer.writerow([
-            'S.No','Booking Date','Project','SPG/Praneeth','Token','Buyer Name','Sale Person Name','CRM Name','SOL',
-            'Type of Sale','Land (sq yards)','SBUA (sq feet)','Facing','Base sq ft price','Amenities and Premiums',
-            'Total Sale Price','Amount Received','Balance Amount','Balance to be received by plan approval','Notes',
-            'Balance to be received during execution'
-        ])
-        for r in rows:
-            r = list(r)
-            # currency fields by index in SELECT: 13,14,15,16,17,18,20
-            for idx in (13,14,15,16,17,18,20):
-                r[idx] = format_currency_csv(r[idx])
-            writer.writerow(r)
-        data = text.getvalue().encode('utf-8')
-        bio = BytesIO(data)
-        bio.seek(0)
-        user = current_user()
-        uname = (user.username if user else 'admin')
-        ts = datetime.today().strftime('%Y%m%d-%H%M%S')
-        return send_file(bio, mimetype='text/csv', as_attachment=True, download_name=f'{uname}_dashboard_{ts}.csv')
-    finally:
-        conn.close()
+    # Use same column set and order as the dashboard table
+    where_sql, params = admin_filter_sql(month, year, crm, sp, spg, tos)
+    query = f"SELECT {SALE_EXPORT_COLUMNS} FROM sale_details WHERE 1=1{where_sql}"
+    user = current_user()
+    uname = (user.username if user else 'admin')
+    return export_response(query, params, request.args.get('format', 'csv'), f'{uname}_dashboard',
+                           cache_filters=(month, year, crm, sp, spg, tos))
 
 @app.route('/admin/crms')
 @login_required(role='ADMIN')
@@ -1016,7 +2580,12 @@ def admin_crms_edit(uid):
             if password:
                 u.password_hash = generate_password_hash(password, method='pbkdf2:sha256')
             u.role = role if role in ('CRM','ADMIN') else u.role
+            # Revoke the user's existing sessions in the same transaction
+            bump_cache_version(db.connection().connection.cursor(), user_cache_key(uid))
             db.commit()
+            if uid == session.get('user_id'):
+                session['role'] = u.role
+                session['auth_ver'] = current_cache_versions().get(user_cache_key(uid), 0)
             flash('User updated', 'success')
     finally:
         db.close()
@@ -1032,6 +2601,7 @@ def admin_crms_delete(uid):
             flash('User not found', 'error')
         else:
             db.delete(u)
+            bump_cache_version(db.connection().connection.cursor(), user_cache_key(uid))
             db.commit()
             flash('User deleted', 'success')
     finally:
@@ -1062,64 +2632,55 @@ def admin_new():
         if errors:
             flash('; '.join(errors), 'error')
             return redirect(url_for('admin_new'))
-        conn = engine.raw_connection()
-        try:
-            cur = conn.cursor()
-            # next s_no
-            cur.execute("SELECT COALESCE(MAX(s_no), 0) + 1 FROM sale_details")
-            next_sno = cur.fetchone()[0]
-            cur.execute(
-                """
-                INSERT INTO sale_details (
-                    s_no, booking_date, project, spg_praneeth, token, buyer_name, sol, type_of_sale,
-                    land_sqyards, sbua_sqft, facing, base_sqft_price, amenties_and_premiums,
-                    total_sale_price, amount_received, balance_amount,
-                    balance_tobe_received_by_plan_approval, notes, balance_tobe_received_during_exec,
-                    sale_person_name, crm_name
-                ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-                """,
-                (
-                    int(next_sno),
-                    data.get('booking_date') or None,
-                    data.get('project'),
-                    spg,
-                    int(data.get('token') or 0) or None,
-                    data.get('buyer_name'),
-                    data.get('sol'),
-                    tos,
-                    int(land) if land else None,
-                    float(sbua) if sbua else None,
-                    data.get('facing'),
-                    float(base) if base else None,
-                    float(prem) if prem else None,
-                    float(total_sale_price),
-                    float(amt_received) if amt_received else None,
-                    float(balance_amount),
-                    float(by_plan),
-                    data.get('notes'),
-                    float(data.get('balance_tobe_received_during_exec') or 0) or None,
-                    data.get('sale_person_name'),
-                    user.username
-                )
+        conn = get_db()
+        cur = conn.cursor()
+        # next s_no, allocated in the insert transaction
+        next_sno = next_sale_sno(cur)
+        cur.execute(
+            """
+            INSERT INTO sale_details (
+                s_no, booking_date, project, spg_praneeth, token, buyer_name, sol, type_of_sale,
+                land_sqyards, sbua_sqft, facing, base_sqft_price, amenties_and_premiums,
+                total_sale_price, amount_received, balance_amount,
+                balance_tobe_received_by_plan_approval, notes, balance_tobe_received_during_exec,
+                sale_person_name, crm_name
+            ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+            """,
+            (
+                int(next_sno),
+                data.get('booking_date') or None,
+                data.get('project'),
+                spg,
+                int(data.get('token') or 0) or None,
+                data.get('buyer_name'),
+                data.get('sol'),
+                tos,
+                int(land) if land else None,
+                float(sbua) if sbua else None,
+                data.get('facing'),
+                float(base) if base else None,
+                float(prem) if prem else None,
+                float(total_sale_price),
+                float(amt_received) if amt_received else None,
+                float(balance_amount),
+                float(by_plan),
+                data.get('notes'),
+                float(data.get('balance_tobe_received_during_exec') or 0) or None,
+                data.get('sale_person_name'),
+                user.username
             )
-            conn.commit()
-        finally:
-            conn.close()
+        )
+        conn.commit()
         # If AJAX request, return JSON so frontend can append s_no and redirect
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return jsonify({"ok": True, "s_no": int(next_sno)})
         flash('Sale created', 'success')
         return redirect(url_for('admin_new', saved=1, s_no=int(next_sno)))
     # GET: provide options, next s_no, and today
-    conn = engine.raw_connection()
-    spg_opts, tos_opts, next_sno = [], [], 1
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT value FROM spg_options ORDER BY value"); spg_opts = [r[0] for r in cur.fetchall()]
-        cur.execute("SELECT value FROM sale_type_options ORDER BY value"); tos_opts = [r[0] for r in cur.fetchall()]
-        cur.execute("SELECT COALESCE(MAX(s_no), 0) + 1 FROM sale_details"); next_sno = cur.fetchone()[0]
-    finally:
-        conn.close()
+    spg_opts, tos_opts = get_options('spg_options'), get_options('sale_type_options')
+    conn = get_db()
+    cur = conn.cursor()
+    next_sno = peek_sale_sno(cur)
     today = datetime.today().strftime('%Y-%m-%d')
     sale_people = get_sales_people_names()
     return render_template('admin_new.html', spg_opts=spg_opts, tos_opts=tos_opts, next_sno=next_sno, today=today, sale_people=sale_people)
@@ -1127,6 +2688,7 @@ def admin_new():
 # Admin: My Entries list (only entries created by this admin)
 @app.route('/admin/entries')
 @login_required(role='ADMIN')
+@etag_cached
 def admin_entries():
     user = current_user()
     sort_by = request.args.get('sort_by','booking_date')
@@ -1138,90 +2700,90 @@ def admin_entries():
     }
     col = allowed.get(sort_by, 'booking_date')
     dir_sql = 'DESC' if sort_dir == 'desc' else 'ASC'
-    if col == 'booking_date' and dir_sql == 'DESC':
-        order_clause = "(booking_date IS NULL) ASC, booking_date DESC, s_no DESC"
-    else:
-        order_clause = f"{col} {dir_sql}"
-    conn = engine.raw_connection()
+    per_page = page_size_arg('per_page', 50)
+    conn = get_db()
     rows = []
-    try:
-        cur = conn.cursor()
-        cur.execute(f"SELECT rowid, * FROM sale_details WHERE crm_name = ? ORDER BY {order_clause}", (user.username,))
-        cols = [d[0] for d in cur.description]
-        for r in cur.fetchall():
-            rec = dict(zip(cols, r))
-            # Compute effective amount received = initial amount + sum(payments)
-            try:
-                rid = rec.get('rowid')
-                cur.execute("SELECT COALESCE(SUM(amount),0) FROM payments WHERE sale_rowid = ?", (rid,))
-                pay_sum = cur.fetchone()[0] or 0
-            except Exception:
-                pay_sum = 0
-            try:
-                base_received = float(rec.get('amount_received') or 0)
-            except Exception:
-                base_received = 0.0
-            rec['amount_received_effective'] = base_received + (pay_sum or 0)
-            # Compute effective balance = total - effective received
-            try:
-                total = float(rec.get('total_sale_price') or 0)
-            except Exception:
-                total = 0.0
-            rec['balance_amount_effective'] = total - rec['amount_received_effective']
-            rows.append(rec)
-    finally:
-        conn.close()
-    return render_template('admin_list.html', rows=rows, user=user, sort_by=col, sort_dir=dir_sql.lower())
+    cur = conn.cursor()
+    page, next_cursor, prev_cursor, total = fetch_keyset_page(
+        cur, "rowid, *", "FROM sale_details WHERE crm_name = ?", [user.username],
+        sale_sort_keys(col, dir_sql), per_page, request.args.get('after'), request.args.get('before'))
+    for rec in page:
+        # Compute effective amount received = initial amount + sum(payments)
+        pay_sum = rec.get('payments_total') or 0
+        try:
+            base_received = float(rec.get('amount_received') or 0)
+        except Exception:
+            base_received = 0.0
+        rec['amount_received_effective'] = base_received + (pay_sum or 0)
+        # Compute effective balance = total - effective received
+        try:
+            sale_total = float(rec.get('total_sale_price') or 0)
+        except Exception:
+            sale_total = 0.0
+        rec['balance_amount_effective'] = sale_total - rec['amount_received_effective']
+        rows.append(rec)
+    return render_template('admin_list.html', rows=rows, user=user, sort_by=col, sort_dir=dir_sql.lower(),
+                           per_page=per_page, total=total, next_cursor=next_cursor, prev_cursor=prev_cursor)
 
 # Admin: Sale detail view
 @app.route('/admin/sales/<int:rowid>')
 @login_required(role='ADMIN')
 def admin_sale_detail(rowid):
     user = current_user()
-    conn = engine.raw_connection()
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT rowid, * FROM sale_details WHERE rowid = ?", (rowid,))
+    row = cur.fetchone()
+    if not row:
+        flash('Not found', 'error')
+        return redirect(url_for('admin_dashboard'))
+    cols = [d[0] for d in cur.description]
+    rec = dict(zip(cols, row))
+    cur.execute("SELECT paid_date, amount, note FROM payments WHERE sale_rowid = ? ORDER BY paid_date DESC, id DESC", (rowid,))
+    payments = cur.fetchall()
+    # Sum of payments to compute effective received
+    pay_sum = rec.get('payments_total') or 0
     try:
-        cur = conn.cursor()
-        cur.execute("SELECT rowid, * FROM sale_details WHERE rowid = ?", (rowid,))
-        row = cur.fetchone()
-        if not row:
-            flash('Not found', 'error')
-            return redirect(url_for('admin_dashboard'))
-        cols = [d[0] for d in cur.description]
-        rec = dict(zip(cols, row))
-        cur.execute("SELECT paid_date, amount, note FROM payments WHERE sale_rowid = ? ORDER BY paid_date DESC, id DESC", (rowid,))
-        payments = cur.fetchall()
-        # Sum of payments to compute effective received
-        cur.execute("SELECT COALESCE(SUM(amount),0) FROM payments WHERE sale_rowid = ?", (rowid,))
-        pay_sum = cur.fetchone()[0] or 0
-        try:
-            base_received = float(rec.get('amount_received') or 0)
-        except Exception:
-            base_received = 0.0
-        amount_received_effective = base_received + (pay_sum or 0)
-        # Prepend initial Amount Received as part of history (display only)
-        try:
-            init_amt = float(rec.get('amount_received') or 0)
-        except Exception:
-            init_amt = 0.0
-        if init_amt > 0:
-            payments = [(rec.get('booking_date'), init_amt, 'Initial Amount Received')] + payments
-        return render_template('admin_sale_detail.html', row=rec, payments=payments, amount_received_effective=amount_received_effective)
-    finally:
-        conn.close()
+        base_received = float(rec.get('amount_received') or 0)
+    except Exception:
+        base_received = 0.0
+    amount_received_effective = base_received + (pay_sum or 0)
+    # Prepend initial Amount Received as part of history (display only)
+    try:
+        init_amt = float(rec.get('amount_received') or 0)
+    except Exception:
+        init_amt = 0.0
+    if init_amt > 0:
+        payments = [(rec.get('booking_date'), init_amt, 'Initial Amount Received')] + payments
+    return render_template('admin_sale_detail.html', row=rec, payments=payments, amount_received_effective=amount_received_effective)
+
+# Typeahead for the sale forms (see suggest_values)
+@app.route('/api/suggest')
+@login_required()
+def api_suggest():
+    field = request.args.get('field', '')
+    if field not in dict(SUGGEST_FIELDS):
+        return jsonify({"ok": False, "error": "Unknown field"}), 400
+    # SQLite reads a negative LIMIT as no limit at all
+    limit = max(1, min(request.args.get('limit', SUGGEST_LIMIT, type=int) or SUGGEST_LIMIT, 50))
+    if field == 'buyer_name':
+        # CRMs only see their own buyers; admins may narrow to one CRM
+        scope = current_user().username if session.get('role') == 'CRM' else (request.args.get('crm_name') or None)
+    else:
+        scope = ''
+    rows = suggest_values(field, request.args.get('q', ''), scope, limit)
+    return jsonify({"ok": True, "field": field, "suggestions": [{"value": v, "uses": n} for v, n in rows]})
 
 # CRM: Manage Sales People
 @app.route('/crm/sales_people')
 @login_required(role='CRM')
 def crm_sales_people():
     user = current_user()
-    conn = engine.raw_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT id, full_name, phone, email, address, title FROM sales_people WHERE owner_username = ? ORDER BY full_name", (user.username,))
-        people = cur.fetchall()
-        return render_template('crm_sales_people.html', people=people)
-    finally:
-        conn.close()
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT id, full_name, phone, email, address, title FROM sales_people WHERE owner_username = ? ORDER BY full_name", (user.username,))
+    people = cur.fetchall()
+    return render_template('crm_sales_people.html', people=people)
 
 @app.route('/crm/sales_people/new', methods=['GET','POST'])
 @login_required(role='CRM')
@@ -1242,15 +2804,13 @@ def crm_sales_people_new():
             fpath = os.path.join(uploads, fname)
             photo.save(fpath)
             photo_path = fpath
-        conn = engine.raw_connection()
-        try:
-            cur = conn.cursor()
-            cur.execute("INSERT INTO sales_people(full_name, phone, email, address, title, photo_path, owner_username) VALUES(?,?,?,?,?,?,?)",
-                        (full_name, phone, email, address, title, photo_path, user.username))
-            conn.commit()
-            flash('Sales person added','success')
-        finally:
-            conn.close()
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("INSERT INTO sales_people(full_name, phone, email, address, title, photo_path, owner_username) VALUES(?,?,?,?,?,?,?)",
+                    (full_name, phone, email, address, title, photo_path, user.username))
+        bump_cache_version(cur, 'sales_people')
+        conn.commit()
+        flash('Sales person added','success')
         return redirect(url_for('crm_sales_people'))
     return render_template('crm_sales_people_form.html', person=None)
 
@@ -1258,58 +2818,54 @@ def crm_sales_people_new():
 @login_required(role='CRM')
 def crm_sales_people_edit(pid):
     user = current_user()
-    conn = engine.raw_connection()
-    try:
-        cur = conn.cursor()
-        if request.method == 'POST':
-            full_name = request.form.get('full_name','').strip()
-            phone = request.form.get('phone')
-            email = request.form.get('email')
-            address = request.form.get('address')
-            title = request.form.get('title')
-            photo = request.files.get('photo')
-            photo_path = None
-            if photo and photo.filename:
-                uploads = os.path.join(BASE_DIR, 'uploads')
-                os.makedirs(uploads, exist_ok=True)
-                fname = f"{int(datetime.now().timestamp())}_{photo.filename}"
-                fpath = os.path.join(uploads, fname)
-                photo.save(fpath)
-                photo_path = fpath
-            sets = ["full_name=?","phone=?","email=?","address=?","title=?"]
-            vals = [full_name, phone, email, address, title]
-            if photo_path:
-                sets.append("photo_path=?")
-                vals.append(photo_path)
-            vals += [user.username, pid]
-            cur.execute(f"UPDATE sales_people SET {', '.join(sets)} WHERE owner_username = ? AND id = ?", tuple(vals))
-            conn.commit()
-            flash('Sales person updated','success')
+    conn = get_db()
+    cur = conn.cursor()
+    if request.method == 'POST':
+        full_name = request.form.get('full_name','').strip()
+        phone = request.form.get('phone')
+        email = request.form.get('email')
+        address = request.form.get('address')
+        title = request.form.get('title')
+        photo = request.files.get('photo')
+        photo_path = None
+        if photo and photo.filename:
+            uploads = os.path.join(BASE_DIR, 'uploads')
+            os.makedirs(uploads, exist_ok=True)
+            fname = f"{int(datetime.now().timestamp())}_{photo.filename}"
+            fpath = os.path.join(uploads, fname)
+            photo.save(fpath)
+            photo_path = fpath
+        sets = ["full_name=?","phone=?","email=?","address=?","title=?"]
+        vals = [full_name, phone, email, address, title]
+        if photo_path:
+            sets.append("photo_path=?")
+            vals.append(photo_path)
+        vals += [user.username, pid]
+        cur.execute(f"UPDATE sales_people SET {', '.join(sets)} WHERE owner_username = ? AND id = ?", tuple(vals))
+        bump_cache_version(cur, 'sales_people')
+        conn.commit()
+        flash('Sales person updated','success')
+        return redirect(url_for('crm_sales_people'))
+    else:
+        cur.execute("SELECT id, full_name, phone, email, address, title, photo_path FROM sales_people WHERE owner_username = ? AND id = ?", (user.username, pid))
+        row = cur.fetchone()
+        if not row:
+            flash('Not found','error')
             return redirect(url_for('crm_sales_people'))
-        else:
-            cur.execute("SELECT id, full_name, phone, email, address, title, photo_path FROM sales_people WHERE owner_username = ? AND id = ?", (user.username, pid))
-            row = cur.fetchone()
-            if not row:
-                flash('Not found','error')
-                return redirect(url_for('crm_sales_people'))
-            cols = [d[0] for d in cur.description]
-            person = dict(zip(cols, row))
-            return render_template('crm_sales_people_form.html', person=person)
-    finally:
-        conn.close()
+        cols = [d[0] for d in cur.description]
+        person = dict(zip(cols, row))
+        return render_template('crm_sales_people_form.html', person=person)
 
 @app.route('/crm/sales_people/<int:pid>/delete', methods=['POST'])
 @login_required(role='CRM')
 def crm_sales_people_delete(pid):
     user = current_user()
-    conn = engine.raw_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute("DELETE FROM sales_people WHERE owner_username = ? AND id = ?", (user.username, pid))
-        conn.commit()
-        flash('Sales person deleted','success')
-    finally:
-        conn.close()
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM sales_people WHERE owner_username = ? AND id = ?", (user.username, pid))
+    bump_cache_version(cur, 'sales_people')
+    conn.commit()
+    flash('Sales person deleted','success')
     return redirect(url_for('crm_sales_people'))
 
 # Admin: Edit own entry
@@ -1317,189 +2873,180 @@ def crm_sales_people_delete(pid):
 @login_required(role='ADMIN')
 def admin_edit(rowid):
     user = current_user()
-    conn = engine.raw_connection()
-    try:
-        cur = conn.cursor()
-        if request.method == 'POST':
-            data = dict(request.form)
-            allowed = ['booking_date','project','spg_praneeth','token','buyer_name','sol','type_of_sale',
-                       'land_sqyards','sbua_sqft','facing','base_sqft_price','amenties_and_premiums',
-                       'amount_received','notes','sale_person_name']
-            sets = []
-            vals = []
-            for k in allowed:
-                if k in data:
-                    sets.append(f"{k}=?")
-                    vals.append(data[k])
-            def cleanf(x):
-                return float(re.sub(r"[^0-9.-]", "", x or '0') or 0)
-            base = cleanf(data.get('base_sqft_price'))
-            prem = cleanf(data.get('amenties_and_premiums'))
-            land = cleanf(data.get('land_sqyards'))
-            sbua = land * 13.5
-            amt_received = cleanf(data.get('amount_received'))
-            tos = (data.get('type_of_sale') or '').upper()
-            total_sale_price, balance_amount, by_plan, during_exec = compute_totals(base, prem, sbua, amt_received, tos)
-            sets += ["sbua_sqft= ?","total_sale_price= ?","balance_amount= ?","balance_tobe_received_by_plan_approval= ?","balance_tobe_received_during_exec= ?"]
-            vals += [sbua, total_sale_price, balance_amount, by_plan, during_exec]
-            vals.append(user.username)
-            vals.append(rowid)
-            sql = f"UPDATE sale_details SET {', '.join(sets)} WHERE crm_name = ? AND rowid = ?"
-            cur.execute(sql, tuple(vals))
-            conn.commit()
+    conn = get_db()
+    cur = conn.cursor()
+    if request.method == 'POST':
+        data = dict(request.form)
+        allowed = ['booking_date','project','spg_praneeth','token','buyer_name','sol','type_of_sale',
+                   'land_sqyards','sbua_sqft','facing','base_sqft_price','amenties_and_premiums',
+                   'amount_received','notes','sale_person_name']
+        sets = []
+        vals = []
+        for k in allowed:
+            if k in data:
+                sets.append(f"{k}=?")
+                vals.append(data[k])
+        def cleanf(x):
+            return float(re.sub(r"[^0-9.-]", "", x or '0') or 0)
+        base = cleanf(data.get('base_sqft_price'))
+        prem = cleanf(data.get('amenties_and_premiums'))
+        land = cleanf(data.get('land_sqyards'))
+        sbua = land * 13.5
+        amt_received = cleanf(data.get('amount_received'))
+        tos = (data.get('type_of_sale') or '').upper()
+        # balances count the payments already recorded, as in the add-payment routes
+        cur.execute("SELECT payments_total FROM sale_details WHERE rowid = ?", (rowid,))
+        paid = cur.fetchone()
+        paid = (paid[0] or 0) if paid else 0
+        total_sale_price, balance_amount, by_plan, during_exec = compute_totals(base, prem, sbua, amt_received + paid, tos)
+        sets += ["sbua_sqft= ?","total_sale_price= ?","balance_amount= ?","balance_tobe_received_by_plan_approval= ?","balance_tobe_received_during_exec= ?"]
+        vals += [sbua, total_sale_price, balance_amount, by_plan, during_exec]
+        vals.append(user.username)
+        vals.append(rowid)
+        sql = f"UPDATE sale_details SET {', '.join(sets)} WHERE crm_name = ? AND rowid = ?"
+        cur.execute(sql, tuple(vals))
+        conn.commit()
+        return redirect(url_for('admin_entries'))
+    else:
+        cur.execute("SELECT rowid, * FROM sale_details WHERE crm_name = ? AND rowid = ?", (user.username, rowid))
+        row = cur.fetchone()
+        if not row:
+            flash('Not found or unauthorized', 'error')
             return redirect(url_for('admin_entries'))
-        else:
-            cur.execute("SELECT rowid, * FROM sale_details WHERE crm_name = ? AND rowid = ?", (user.username, rowid))
-            row = cur.fetchone()
-            if not row:
-                flash('Not found or unauthorized', 'error')
-                return redirect(url_for('admin_entries'))
-            cols = [d[0] for d in cur.description]
-            rec = dict(zip(cols, row))
-            # payments
-            cur.execute("SELECT paid_date, amount, note FROM payments WHERE sale_rowid = ? ORDER BY paid_date DESC, id DESC", (rowid,))
-            payments = cur.fetchall()
-            cur.execute("SELECT COALESCE(SUM(amount),0) FROM payments WHERE sale_rowid = ?", (rowid,))
-            pay_total = cur.fetchone()[0] or 0
-            # Show initial Amount Received as part of history (display only)
-            try:
-                init_amt = float(rec.get('amount_received') or 0)
-            except Exception:
-                init_amt = 0.0
-            if init_amt > 0:
-                payments = [(rec.get('booking_date'), init_amt, 'Initial Amount Received')] + payments
-            return render_template('crm_edit.html', row=rec, user=user, payments=payments, payments_total=pay_total)
-    finally:
-        conn.close()
+        cols = [d[0] for d in cur.description]
+        rec = dict(zip(cols, row))
+        # payments
+        cur.execute("SELECT paid_date, amount, note FROM payments WHERE sale_rowid = ? ORDER BY paid_date DESC, id DESC", (rowid,))
+        payments = cur.fetchall()
+        pay_total = rec.get('payments_total') or 0
+        # Show initial Amount Received as part of history (display only)
+        try:
+            init_amt = float(rec.get('amount_received') or 0)
+        except Exception:
+            init_amt = 0.0
+        if init_amt > 0:
+            payments = [(rec.get('booking_date'), init_amt, 'Initial Amount Received')] + payments
+        return render_template('crm_edit.html', row=rec, user=user, payments=payments, payments_total=pay_total)
 
 # Add payment (CRM)
 @app.route('/crm/edit/<int:rowid>/add_payment', methods=['POST'])
 @login_required(role='CRM')
 def crm_add_payment(rowid):
     user = current_user()
-    conn = engine.raw_connection()
+    conn = get_db()
+    cur = conn.cursor()
+    # Ownership check
+    cur.execute("SELECT total_sale_price, amount_received, type_of_sale FROM sale_details WHERE rowid = ? AND crm_name = ?", (rowid, user.username))
+    row = cur.fetchone()
+    if not row:
+        flash('Not found or unauthorized', 'error')
+        return redirect(url_for('crm_list'))
+    total_sale_price, amount_received, tos = row[0] or 0, row[1] or 0, (row[2] or '').upper()
+    paid_date = request.form.get('paid_date') or datetime.now().strftime('%Y-%m-%dT%H:%M')
+    amount = request.form.get('amount') or '0'
+    note = request.form.get('note')
     try:
-        cur = conn.cursor()
-        # Ownership check
-        cur.execute("SELECT total_sale_price, amount_received, type_of_sale FROM sale_details WHERE rowid = ? AND crm_name = ?", (rowid, user.username))
-        row = cur.fetchone()
-        if not row:
-            flash('Not found or unauthorized', 'error')
-            return redirect(url_for('crm_list'))
-        total_sale_price, amount_received, tos = row[0] or 0, row[1] or 0, (row[2] or '').upper()
-        paid_date = request.form.get('paid_date') or datetime.now().strftime('%Y-%m-%dT%H:%M')
-        amount = request.form.get('amount') or '0'
-        note = request.form.get('note')
-        try:
-            amt = float(re.sub(r"[^0-9.-]", "", amount) or 0)
-        except:
-            amt = 0
-        if amt <= 0:
-            flash('Amount must be positive', 'error')
-            return redirect(url_for('crm_edit', rowid=rowid))
-        cur.execute("INSERT INTO payments(sale_rowid, paid_date, amount, note) VALUES(?,?,?,?)", (rowid, paid_date, amt, note))
-        # recompute balances using amount_received + sum(payments)
-        cur.execute("SELECT COALESCE(SUM(amount),0) FROM payments WHERE sale_rowid = ?", (rowid,))
-        pay_sum = cur.fetchone()[0] or 0
-        effective_received = (amount_received or 0) + pay_sum
-        balance = (total_sale_price or 0) - effective_received
-        if tos == 'OTP':
-            by_plan = balance
-            during_exec = 0.0
-        else:
-            by_plan = max((total_sale_price or 0) * 0.25 - effective_received, 0.0)
-            during_exec = max(balance - by_plan, 0.0)
-        cur.execute("UPDATE sale_details SET balance_amount = ?, balance_tobe_received_by_plan_approval = ?, balance_tobe_received_during_exec = ? WHERE rowid = ?", (balance, by_plan, during_exec, rowid))
-        conn.commit()
-        flash('Payment added', 'success')
+        amt = float(re.sub(r"[^0-9.-]", "", amount) or 0)
+    except:
+        amt = 0
+    if amt <= 0:
+        flash('Amount must be positive', 'error')
         return redirect(url_for('crm_edit', rowid=rowid))
-    finally:
-        conn.close()
+    cur.execute("INSERT INTO payments(sale_rowid, paid_date, amount, note) VALUES(?,?,?,?)", (rowid, paid_date, amt, note))
+    # recompute balances using amount_received + sum(payments); the insert trigger has
+    # already rolled this payment into payments_total, so no history scan is needed
+    cur.execute("SELECT payments_total FROM sale_details WHERE rowid = ?", (rowid,))
+    pay_sum = cur.fetchone()[0] or 0
+    effective_received = (amount_received or 0) + pay_sum
+    balance = (total_sale_price or 0) - effective_received
+    if tos == 'OTP':
+        by_plan = balance
+        during_exec = 0.0
+    else:
+        by_plan = max((total_sale_price or 0) * 0.25 - effective_received, 0.0)
+        during_exec = max(balance - by_plan, 0.0)
+    cur.execute("UPDATE sale_details SET balance_amount = ?, balance_tobe_received_by_plan_approval = ?, balance_tobe_received_during_exec = ? WHERE rowid = ?", (balance, by_plan, during_exec, rowid))
+    conn.commit()
+    flash('Payment added', 'success')
+    return redirect(url_for('crm_edit', rowid=rowid))
 
 # Add payment (Admin)
 @app.route('/admin/edit/<int:rowid>/add_payment', methods=['POST'])
 @login_required(role='ADMIN')
 def admin_add_payment(rowid):
     user = current_user()
-    conn = engine.raw_connection()
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT total_sale_price, amount_received, type_of_sale FROM sale_details WHERE rowid = ? AND crm_name = ?", (rowid, user.username))
+    row = cur.fetchone()
+    if not row:
+        flash('Not found or unauthorized', 'error')
+        return redirect(url_for('admin_entries'))
+    total_sale_price, amount_received, tos = row[0] or 0, row[1] or 0, (row[2] or '').upper()
+    paid_date = request.form.get('paid_date') or datetime.now().strftime('%Y-%m-%dT%H:%M')
+    amount = request.form.get('amount') or '0'
+    note = request.form.get('note')
     try:
-        cur = conn.cursor()
-        cur.execute("SELECT total_sale_price, amount_received, type_of_sale FROM sale_details WHERE rowid = ? AND crm_name = ?", (rowid, user.username))
-        row = cur.fetchone()
-        if not row:
-            flash('Not found or unauthorized', 'error')
-            return redirect(url_for('admin_entries'))
-        total_sale_price, amount_received, tos = row[0] or 0, row[1] or 0, (row[2] or '').upper()
-        paid_date = request.form.get('paid_date') or datetime.now().strftime('%Y-%m-%dT%H:%M')
-        amount = request.form.get('amount') or '0'
-        note = request.form.get('note')
-        try:
-            amt = float(re.sub(r"[^0-9.-]", "", amount) or 0)
-        except:
-            amt = 0
-        if amt <= 0:
-            flash('Amount must be positive', 'error')
-            return redirect(url_for('admin_edit', rowid=rowid))
-        cur.execute("INSERT INTO payments(sale_rowid, paid_date, amount, note) VALUES(?,?,?,?)", (rowid, paid_date, amt, note))
-        cur.execute("SELECT COALESCE(SUM(amount),0) FROM payments WHERE sale_rowid = ?", (rowid,))
-        pay_sum = cur.fetchone()[0] or 0
-        effective_received = (amount_received or 0) + pay_sum
-        balance = (total_sale_price or 0) - effective_received
-        if tos == 'OTP':
-            by_plan = balance
-            during_exec = 0.0
-        else:
-            by_plan = max((total_sale_price or 0) * 0.25 - effective_received, 0.0)
-            during_exec = max(balance - by_plan, 0.0)
-        cur.execute("UPDATE sale_details SET balance_amount = ?, balance_tobe_received_by_plan_approval = ?, balance_tobe_received_during_exec = ? WHERE rowid = ?", (balance, by_plan, during_exec, rowid))
-        conn.commit()
-        flash('Payment added', 'success')
+        amt = float(re.sub(r"[^0-9.-]", "", amount) or 0)
+    except:
+        amt = 0
+    if amt <= 0:
+        flash('Amount must be positive', 'error')
         return redirect(url_for('admin_edit', rowid=rowid))
-    finally:
-        conn.close()
+    cur.execute("INSERT INTO payments(sale_rowid, paid_date, amount, note) VALUES(?,?,?,?)", (rowid, paid_date, amt, note))
+    cur.execute("SELECT payments_total FROM sale_details WHERE rowid = ?", (rowid,))
+    pay_sum = cur.fetchone()[0] or 0
+    effective_received = (amount_received or 0) + pay_sum
+    balance = (total_sale_price or 0) - effective_received
+    if tos == 'OTP':
+        by_plan = balance
+        during_exec = 0.0
+    else:
+        by_plan = max((total_sale_price or 0) * 0.25 - effective_received, 0.0)
+        during_exec = max(balance - by_plan, 0.0)
+    cur.execute("UPDATE sale_details SET balance_amount = ?, balance_tobe_received_by_plan_approval = ?, balance_tobe_received_during_exec = ? WHERE rowid = ?", (balance, by_plan, during_exec, rowid))
+    conn.commit()
+    flash('Payment added', 'success')
+    return redirect(url_for('admin_edit', rowid=rowid))
 
 # Admin: Delete own entry
 @app.route('/admin/delete/<int:rowid>', methods=['POST'])
 @login_required(role='ADMIN')
 def admin_delete(rowid):
     user = current_user()
-    conn = engine.raw_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute("DELETE FROM sale_details WHERE rowid = ? AND crm_name = ?", (rowid, user.username))
-        conn.commit()
-        flash('Entry deleted', 'success')
-    finally:
-        conn.close()
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM sale_details WHERE rowid = ? AND crm_name = ?", (rowid, user.username))
+    conn.commit()
+    flash('Entry deleted', 'success')
     return redirect(url_for('admin_entries'))
 
 @app.route('/admin/options', methods=['GET','POST'])
 @login_required(role='ADMIN')
 def admin_options():
-    conn = engine.raw_connection()
-    try:
-        cur = conn.cursor()
-        if request.method == 'POST':
-            kind = request.form.get('kind')
-            val = (request.form.get('value') or '').strip()
-            action = request.form.get('action')
-            table = 'spg_options' if kind == 'spg' else 'sale_type_options'
-            if action == 'add' and val:
-                try:
-                    cur.execute(f"INSERT INTO {table}(value) VALUES (?)", (val,))
-                    conn.commit()
-                    flash('Option added', 'success')
-                except Exception:
-                    flash('Option exists or invalid', 'error')
-            elif action == 'delete' and val:
-                cur.execute(f"DELETE FROM {table} WHERE value = ?", (val,))
+    conn = get_db()
+    cur = conn.cursor()
+    if request.method == 'POST':
+        kind = request.form.get('kind')
+        val = (request.form.get('value') or '').strip()
+        action = request.form.get('action')
+        table = 'spg_options' if kind == 'spg' else 'sale_type_options'
+        if action == 'add' and val:
+            try:
+                cur.execute(f"INSERT INTO {table}(value) VALUES (?)", (val,))
+                bump_cache_version(cur, table)
                 conn.commit()
-                flash('Option deleted', 'success')
-        cur.execute("SELECT value FROM spg_options ORDER BY value"); spg = [r[0] for r in cur.fetchall()]
-        cur.execute("SELECT value FROM sale_type_options ORDER BY value"); tos = [r[0] for r in cur.fetchall()]
-        return render_template('admin_options.html', spg=spg, tos=tos)
-    finally:
-        conn.close()
+                flash('Option added', 'success')
+            except Exception:
+                flash('Option exists or invalid', 'error')
+        elif action == 'delete' and val:
+            cur.execute(f"DELETE FROM {table} WHERE value = ?", (val,))
+            bump_cache_version(cur, table)
+            conn.commit()
+            flash('Option deleted', 'success')
+    spg = get_options('spg_options')
+    tos = get_options('sale_type_options')
+    return render_template('admin_options.html', spg=spg, tos=tos)
 
 # Static helper route for field rules (shown as tooltips/help)
 @app.route('/field-rules')
@@ -1510,5 +3057,67 @@ def field_rules():
         'calculated': 'Calculated: total_sale_price, balance_amount, balance_tobe_received_by_plan_approval',
     })
 
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    """Run EXPLAIN QUERY PLAN on the dashboard/export filters and fail if any scans sale_details."""
+    cases = [
+        ('year', ('', '2025', None, None, None, None)),
+        ('year+month', ('3', '2025', None, None, None, None)),
+        ('year+crm', ('', '2025', 'vasu', None, None, None)),
+        ('year+month+sale_person', ('3', '2025', None, 'someone', None, None)),
+        ('year+spg', ('', '2025', None, None, 'SPG', None)),
+        ('year+type_of_sale', ('', '2025', None, None, None, 'OTP')),
+        ('crm only', ('', '', 'vasu', None, None, None)),
+    ]
+    conn = engine.raw_connection()
+    failed = False
+    try:
+        cur = conn.cursor()
+        for label, args in cases:
+            where_sql, params = admin_filter_sql(*args)
+            cur.execute(f"EXPLAIN QUERY PLAN SELECT {SALE_EXPORT_COLUMNS} FROM sale_details WHERE 1=1{where_sql}", tuple(params))
+            details = [r[-1] for r in cur.fetchall()]
+            uses_index = any('sale_details USING' in d and 'INDEX' in d for d in details)
+            failed = failed or not uses_index
+            print(f"{'ok  ' if uses_index else 'SCAN'} {label}: {' | '.join(details)}")
+    finally:
+        conn.close()
+    if failed:
+        raise SystemExit(1)
+
+@app.cli.command('check-import')
+def check_import_command():
+    """Re-import a changed row with the importers' upsert against this schema, then roll back."""
+    # The importers live next to the database, outside the webapp package
+    sys.path.insert(0, os.path.dirname(DB_PATH))
+    from create_sales_database import SALE_COLUMNS, UPSERT_SQL
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT COALESCE(MAX(s_no), 0) + 1 FROM sale_details")
+        s_no = cur.fetchone()[0]
+        row = dict.fromkeys(SALE_COLUMNS)
+        row.update(s_no=s_no, project='check-import', buyer_name='check-import', sale_person_name='check-import',
+                   crm_name='check-import', spg_praneeth='SPG', type_of_sale='OTP', amount_received=1.0)
+        try:
+            # two rows sharing project, buyer and sales person, then the first one again
+            # changed: the ON CONFLICT(s_no) path with its suggest terms still in use
+            cur.execute(UPSERT_SQL, [row[c] for c in SALE_COLUMNS])
+            cur.execute(UPSERT_SQL, [s_no + 1 if c == 's_no' else row[c] for c in SALE_COLUMNS])
+            row['amount_received'] = 2.0
+            cur.execute(UPSERT_SQL, [row[c] for c in SALE_COLUMNS])
+            cur.execute("SELECT amount_received FROM sale_details WHERE s_no = ?", (s_no,))
+            ok = cur.fetchone()[0] == 2.0
+            print(f"{'ok  ' if ok else 'FAIL'} incremental re-import of a changed row" + ('' if ok else ': update not applied'))
+        except sqlite3.Error as e:
+            ok = False
+            print(f"FAIL incremental re-import of a changed row: {e}")
+        finally:
+            conn.rollback()
+    finally:
+        conn.close()
+    if not ok:
+        raise SystemExit(1)
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -227,3 +227,93 @@ if (document.readyState === 'loading'){
 } else {
   formatCurrencyNodes();
 }
+
+// Poll background job status (e.g. WhatsApp delivery) until it finishes
+const JOB_POLL_LIMIT_MS = 10 * 60 * 1000;
+function pollJobStatus(){
+  document.querySelectorAll('.job-status[data-job-url]').forEach(el=>{
+    const url = el.getAttribute('data-job-url');
+    const started = Date.now();
+    // Stop asking after a while; a job can't outlive the app process that runs it
+    const again = (ms)=>{
+      if(Date.now() - started < JOB_POLL_LIMIT_MS){ setTimeout(tick, ms); }
+      else { el.textContent += ' - stopped checking, reload the page to check again'; }
+    };
+    const tick = async ()=>{
+      try{
+        const res = await fetch(url, { headers: { 'X-Requested-With': 'XMLHttpRequest' } });
+        const data = await res.json();
+        if(!data.ok){ el.textContent = data.error || 'Job not found'; return; }
+        const job = data.job;
+        let text = `Job #${job.id}: ${job.status}`;
+        if(job.result && job.result.total !== undefined){
+          text += ` (${job.result.sent}/${job.result.total} sent`;
+          if(job.result.failed){ text += `, ${job.result.failed} failed`; }
+          if(job.result.latency_ms && job.result.latency_ms.p95 !== undefined){ text += `, p95 ${job.result.latency_ms.p95} ms`; }
+          text += ')';
+        } else if(job.result && job.result.drifted_rows !== undefined){
+          text += ` (${job.result.rows} rows checked, ${job.result.drifted_rows} drifted${job.result.applied ? ', fixed' : ''})`;
+        } else if(job.status === 'done' && job.result && job.result.message_id){ text += ` (id=${job.result.message_id})`; }
+        if(job.error && job.status !== 'done'){ text += ` - ${job.error}`; }
+        el.textContent = text;
+        el.className = 'job-status ' + job.status;
+        if(job.status === 'queued' || job.status === 'running'){ again(2000); }
+      }catch(e){
+        again(5000);
+      }
+    };
+    tick();
+  });
+}
+if (document.readyState === 'loading'){
+  document.addEventListener('DOMContentLoaded', pollJobStatus);
+} else {
+  pollJobStatus();
+}
+
+// Typeahead for inputs with data-suggest-url: fills a <datalist> from /api/suggest,
+// waiting for a pause in typing and dropping responses to superseded keystrokes
+const SUGGEST_DEBOUNCE_MS = 150;
+function initSuggest(){
+  document.querySelectorAll('input[data-suggest-url]').forEach((input, i)=>{
+    const list = document.createElement('datalist');
+    list.id = `suggest-${input.name}-${i}`;
+    input.after(list);
+    input.setAttribute('list', list.id);
+    const url = input.getAttribute('data-suggest-url');
+    const cache = new Map();
+    let timer = null, controller = null;
+    const render = (items)=>{
+      list.innerHTML = '';
+      items.forEach(s=>{
+        const opt = document.createElement('option');
+        opt.value = s.value;
+        opt.label = `${s.uses} sale${s.uses === 1 ? '' : 's'}`;
+        list.appendChild(opt);
+      });
+    };
+    const lookup = async (q)=>{
+      if(cache.has(q)){ render(cache.get(q)); return; }
+      if(controller){ controller.abort(); }
+      controller = new AbortController();
+      try{
+        const res = await fetch(`${url}&q=${encodeURIComponent(q)}`, { signal: controller.signal, headers: { 'X-Requested-With': 'XMLHttpRequest' } });
+        const data = await res.json();
+        if(!data.ok) return;
+        cache.set(q, data.suggestions);
+        render(data.suggestions);
+      }catch(e){ /* aborted or offline: keep the current list */ }
+    };
+    input.addEventListener('input', ()=>{
+      clearTimeout(timer);
+      const q = input.value.trim();
+      if(!q){ render([]); return; }
+      timer = setTimeout(()=>lookup(q), SUGGEST_DEBOUNCE_MS);
+    });
+  });
+}
+if (document.readyState === 'loading'){
+  document.addEventListener('DOMContentLoaded', initSuggest);
+} else {
+  initSuggest();
+}